@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+"""
+Time the real warehousing pipeline against a synthetic project served by
+local REDCap and BRP-eHB stand-ins, loading into a local database.
+
+    python -m benchmarks.run --subjects 2000 --instruments 10 -- --stream
+
+Arguments after -- are passed through to warehouse_project.py. Each run's
+per-stage timings are appended to the results file along with the git
+revision, and compared with the last recorded run of the same size and
+pipeline arguments.
+"""
+import argparse
+import json
+import os
+import subprocess
+import tempfile
+import time
+
+from sqlalchemy import create_engine, event
+
+import warehouse_project
+from benchmarks.stubs import BRPHandler, REDCapHandler, StubServer
+from benchmarks.synthetic import SyntheticProject
+
+ENV = {
+    "BENCH_REDCAP_TOKEN": "benchmark",
+    "BENCH_BRP_TOKEN": "benchmark",
+    "BENCH_CID_MAGIC_NUMBER": "7",
+}
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def sqlite_engine(path, schema_name):
+    """SQLite engine with the project schema attached as its own database"""
+    engine = create_engine(f"sqlite:///{path}")
+
+    @event.listens_for(engine, "connect")
+    def attach(dbapi_conn, _):
+        dbapi_conn.execute(
+            f"ATTACH DATABASE '{path}.{schema_name}' AS \"{schema_name}\""
+        )
+
+    return engine
+
+
+def stage_seconds(metrics):
+    """Total seconds per stage name (per-table stages are summed)"""
+    totals = {}
+    for st in metrics["stages"]:
+        totals[st["stage"]] = round(
+            totals.get(st["stage"], 0) + st["seconds"], 3
+        )
+    return totals
+
+
+def previous_result(path, size, pipeline_args):
+    """
+    The last result in path for the same synthetic project size run with the
+    same pipeline arguments, or None
+    """
+    if not os.path.exists(path):
+        return None
+    last = None
+    with open(path) as f:
+        for line in f:
+            r = json.loads(line)
+            if (
+                r["size"] == size
+                and r.get("pipeline_args", []) == pipeline_args
+            ):
+                last = r
+    return last
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument("--subjects", type=int, default=500)
+    parser.add_argument("--instruments", type=int, default=5)
+    parser.add_argument("--instances", type=int, default=3)
+    parser.add_argument("--date_fields", type=int, default=3)
+    parser.add_argument("--note_fields", type=int, default=1)
+    parser.add_argument("--other_fields", type=int, default=5)
+    parser.add_argument(
+        "--new_subjects",
+        type=float,
+        default=0.1,
+        help="Fraction of subjects that have to be created in the BRP-eHB",
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=1, help="Times to run the pipeline"
+    )
+    parser.add_argument(
+        "--db_url",
+        help="Warehouse database URL (default: a temporary SQLite database)",
+    )
+    parser.add_argument(
+        "--results",
+        default=os.path.join(os.path.dirname(__file__), "results.jsonl"),
+        help="File to append results to",
+    )
+    args, pipeline_args = parser.parse_known_args()
+    if pipeline_args[:1] == ["--"]:
+        pipeline_args = pipeline_args[1:]
+
+    size = {
+        k: getattr(args, k)
+        for k in (
+            "subjects",
+            "instruments",
+            "instances",
+            "date_fields",
+            "note_fields",
+            "other_fields",
+            "new_subjects",
+        )
+    }
+    start = time.perf_counter()
+    project = SyntheticProject(**size)
+    print(
+        f"Generated synthetic project in {time.perf_counter() - start:.1f} s"
+    )
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_url = args.db_url or f"sqlite:///{tmp}/warehouse.db"
+        os.environ.update(ENV, BENCH_DB_URL=db_url)
+        if not args.db_url:
+            warehouse_project._db_engines[db_url] = sqlite_engine(
+                f"{tmp}/warehouse.db", f"redcap_{project.project_id}"
+            )
+
+        runs = []
+        with StubServer(REDCapHandler, project) as redcap, StubServer(
+            BRPHandler, project
+        ) as brp:
+            for i in range(args.repeat):
+                metrics_file = os.path.join(tmp, f"metrics_{i}.json")
+                argv = [
+                    "BENCH_REDCAP_TOKEN",
+                    "BENCH_BRP_TOKEN",
+                    str(project.protocol_id),
+                    "BENCH_CID_MAGIC_NUMBER",
+                    "BENCH_DB_URL",
+                    "--redcap_api_url",
+                    redcap.url,
+                    "--brp_api_url",
+                    brp.url,
+                    "--redcap_organization_override_value",
+                    "102",
+                    "--state_dir",
+                    os.path.join(tmp, "state"),
+                    "--metrics_file",
+                    metrics_file,
+                    # repeats load the same data, which would otherwise be
+                    # skipped as unchanged after the first
+                    "--rewrite_unchanged",
+                    *pipeline_args,
+                ]
+                warehouse_project.main(argv)
+                with open(metrics_file) as f:
+                    runs.append(json.load(f))
+
+    result = {
+        "revision": git_revision(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "size": size,
+        "pipeline_args": pipeline_args,
+        "runs": [
+            {
+                "seconds": m["seconds"],
+                "peak_rss_mb": m["peak_rss_mb"],
+                "stages": stage_seconds(m),
+            }
+            for m in runs
+        ],
+    }
+    last = previous_result(args.results, size, pipeline_args)
+    with open(args.results, "a") as f:
+        f.write(json.dumps(result) + "\n")
+
+    best = min(result["runs"], key=lambda r: r["seconds"])
+    prev = min(last["runs"], key=lambda r: r["seconds"]) if last else None
+
+    def column(seconds):
+        return "" if seconds is None else f"{seconds:>10.2f}"
+
+    print(f"\n{'stage':<20}{'seconds':>10}{'previous':>10}")
+    for stage, seconds in best["stages"].items():
+        before = prev["stages"].get(stage) if prev else None
+        print(f"{stage:<20}{column(seconds)}{column(before)}")
+    before = prev["seconds"] if prev else None
+    print(f"{'total':<20}{column(best['seconds'])}{column(before)}")
+    if last:
+        print(f"(previous: {last['revision']} at {last['time']})")
+    print(f"Peak memory: {best['peak_rss_mb']:.0f} MB")
+
+
+if __name__ == "__main__":
+    main()
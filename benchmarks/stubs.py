@@ -0,0 +1,178 @@
+"""
+Local stand-ins for the REDCap API and the BRP-eHB API, served over HTTP
+from a SyntheticProject.
+"""
+import json
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body):
+        payload = (
+            body if isinstance(body, bytes) else json.dumps(body).encode()
+        )
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+
+def _param_list(form, name):
+    """Values of an array parameter sent as name[0]=.. or name=a,b"""
+    values = [
+        v
+        for k, vs in sorted(form.items())
+        if re.fullmatch(rf"{name}\[\d*\]", k)
+        for v in vs
+    ]
+    for v in form.get(name, []):
+        values += [x for x in v.split(",") if x]
+    return values
+
+
+class REDCapHandler(_Handler):
+    """Answers REDCap API export requests (and record imports)"""
+
+    project = None
+
+    def do_POST(self):
+        form = {
+            k: v
+            for k, v in parse_qs(
+                self._body().decode(), keep_blank_values=True
+            ).items()
+        }
+        get = lambda k, default="": form.get(k, [default])[0]  # noqa: E731
+        content = get("content")
+        p = self.project
+
+        if content == "record" and get("data"):
+            self._send(200, {"count": len(json.loads(get("data")))})
+        elif content == "record":
+            self._send(
+                200,
+                p.export_records(
+                    records=_param_list(form, "records"),
+                    fields=_param_list(form, "fields"),
+                    eav=get("type") == "eav",
+                    label=get("rawOrLabel") == "label",
+                ),
+            )
+        elif content == "metadata":
+            self._send(200, p.metadata)
+        elif content == "project":
+            self._send(200, p.project_info())
+        elif content == "formEventMapping":
+            self._send(200, p.form_event_mapping())
+        elif content == "event":
+            self._send(
+                200,
+                [
+                    {
+                        "event_name": "Baseline",
+                        "arm_num": 1,
+                        "unique_event_name": "baseline_arm_1",
+                    }
+                ],
+            )
+        elif content == "arm":
+            self._send(200, [{"arm_num": 1, "name": "Arm 1"}])
+        elif content == "instrument":
+            self._send(
+                200,
+                [
+                    {"instrument_name": f, "instrument_label": f}
+                    for f in p.forms
+                ],
+            )
+        elif content == "repeatingFormsEvents":
+            self._send(
+                200,
+                [
+                    {
+                        "event_name": "baseline_arm_1",
+                        "form_name": f,
+                        "custom_form_label": "",
+                    }
+                    for f in p.repeating_forms
+                ],
+            )
+        elif content == "exportFieldNames":
+            self._send(
+                200,
+                [
+                    {
+                        "original_field_name": f,
+                        "choice_value": "",
+                        "export_field_name": f,
+                    }
+                    for f in p.field_names
+                ],
+            )
+        elif content == "version":
+            self._send(200, b"13.0.0")
+        else:
+            self._send(400, {"error": f"Unsupported content '{content}'"})
+
+
+class BRPHandler(_Handler):
+    """Answers BRP-eHB protocol subject list and create requests"""
+
+    project = None
+    lock = threading.Lock()
+
+    def do_GET(self):
+        m = re.fullmatch(r"/api/protocols/(\d+)/subjects/?", self.path)
+        if not m:
+            return self._send(404, {"detail": "Not found"})
+        with self.lock:
+            self._send(200, self.project.brp_subjects)
+
+    def do_POST(self):
+        m = re.fullmatch(r"/api/protocols/(\d+)/subjects/create/?", self.path)
+        if not m:
+            return self._send(404, {"detail": "Not found"})
+        subject = json.loads(self._body() or b"{}")
+        with self.lock:
+            subjects = self.project.brp_subjects
+            subject["id"] = max((s["id"] for s in subjects), default=0) + 1
+            subjects.append(subject)
+        self._send(200, [True, subject, []])
+
+
+class StubServer:
+    """Serve a handler class for a SyntheticProject on a local port"""
+
+    def __init__(self, handler, project):
+        handler = type(handler.__name__, (handler,), {"project": project})
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(
+            target=self.httpd.serve_forever, daemon=True
+        )
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address
+        return f"http://{host}:{port}/api/"
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
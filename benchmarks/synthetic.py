@@ -0,0 +1,235 @@
+"""
+Synthetic REDCap projects and BRP-eHB protocols of configurable size for
+benchmarking the pipeline offline.
+"""
+import random
+from datetime import date, timedelta
+
+EVENT = "baseline_arm_1"
+ENROLLMENT_FORM = "enrollment"
+ORGANIZATION = 102
+ORGANIZATION_LABEL = "CHOP"
+COMPLETE = ("2", "Complete")
+
+
+def _field(
+    name, form, field_type="text", validation="", choices="", identifier=""
+):
+    return {
+        "field_name": name,
+        "form_name": form,
+        "section_header": "",
+        "field_type": field_type,
+        "field_label": name.replace("_", " ").title(),
+        "select_choices_or_calculations": choices,
+        "field_note": "",
+        "text_validation_type_or_show_slider_number": validation,
+        "text_validation_min": "",
+        "text_validation_max": "",
+        "identifier": identifier,
+        "branching_logic": "",
+        "required_field": "",
+        "custom_alignment": "",
+        "question_number": "",
+        "matrix_group_name": "",
+        "matrix_ranking": "",
+        "field_annotation": "",
+    }
+
+
+def _random_date(rng, start_year, end_year):
+    start = date(start_year, 1, 1)
+    return start + timedelta(days=rng.randrange((end_year - start_year) * 365))
+
+
+class SyntheticProject:
+    """
+    A longitudinal (single event) REDCap project with an enrollment form and
+    repeating instruments, plus the matching BRP-eHB protocol subjects.
+
+        Parameters:
+            subjects (int): Enrolled subjects
+            instruments (int): Repeating instruments besides enrollment
+            instances (int): Repeat instances of each instrument per subject
+            date_fields (int): Date fields per instrument
+            note_fields (int): Notes fields per instrument
+            other_fields (int): Plain text fields per instrument
+            new_subjects (float): Fraction of subjects not yet in the BRP-eHB
+            seed (int): Random seed, so the same sizes give the same data
+    """
+
+    def __init__(
+        self,
+        subjects=100,
+        instruments=5,
+        instances=3,
+        date_fields=3,
+        note_fields=1,
+        other_fields=5,
+        new_subjects=0.0,
+        project_id=99999,
+        protocol_id=1,
+        seed=0,
+    ):
+        rng = random.Random(seed)
+        self.project_id = project_id
+        self.protocol_id = protocol_id
+
+        self.forms = [ENROLLMENT_FORM] + [
+            f"form_{i}" for i in range(1, instruments + 1)
+        ]
+        self.repeating_forms = self.forms[1:]
+
+        org_choices = f"{ORGANIZATION}, {ORGANIZATION_LABEL} | 999, Other"
+        self.metadata = [
+            _field("record_id", ENROLLMENT_FORM),
+            _field("first_name", ENROLLMENT_FORM, identifier="y"),
+            _field("last_name", ENROLLMENT_FORM, identifier="y"),
+            _field(
+                "dob", ENROLLMENT_FORM, validation="date_ymd", identifier="y"
+            ),
+            _field("external_id", ENROLLMENT_FORM, identifier="y"),
+            _field(
+                "organization",
+                ENROLLMENT_FORM,
+                "dropdown",
+                choices=org_choices,
+            ),
+        ]
+        for form in self.repeating_forms:
+            self.metadata += [
+                _field(f"{form}_date_{j}", form, validation="date_ymd")
+                for j in range(date_fields)
+            ]
+            self.metadata += [
+                _field(f"{form}_note_{j}", form, "notes")
+                for j in range(note_fields)
+            ]
+            self.metadata += [
+                _field(f"{form}_value_{j}", form, validation="integer")
+                for j in range(other_fields)
+            ]
+        self.labels = {
+            "organization": {
+                str(ORGANIZATION): ORGANIZATION_LABEL,
+                "999": "Other",
+            },
+            **{f"{form}_complete": dict([COMPLETE]) for form in self.forms},
+        }
+
+        # records as {record_id: [(repeat_instrument, instance, {field: raw})]}
+        self.records = {}
+        self.brp_subjects = []
+        for n in range(1, subjects + 1):
+            record_id = str(n)
+            external_id = f"EXT{n:07d}"
+            rows = [
+                (
+                    "",
+                    "",
+                    {
+                        "record_id": record_id,
+                        "first_name": f"First{n}",
+                        "last_name": f"Last{n}",
+                        # some subjects are 90+ so their dates get discarded
+                        "dob": _random_date(rng, 1925, 2020).isoformat(),
+                        "external_id": external_id,
+                        "organization": str(ORGANIZATION),
+                        f"{ENROLLMENT_FORM}_complete": COMPLETE[0],
+                    },
+                )
+            ]
+            for form in self.repeating_forms:
+                for instance in range(1, instances + 1):
+                    values = {f"{form}_complete": COMPLETE[0]}
+                    for j in range(date_fields):
+                        values[f"{form}_date_{j}"] = _random_date(
+                            rng, 2000, 2024
+                        ).isoformat()
+                    for j in range(note_fields):
+                        values[f"{form}_note_{j}"] = f"Note {n}.{instance}.{j}"
+                    for j in range(other_fields):
+                        values[f"{form}_value_{j}"] = str(rng.randrange(1000))
+                    rows.append((form, str(instance), values))
+            self.records[record_id] = rows
+
+            if rng.random() >= new_subjects:
+                self.brp_subjects.append(
+                    {
+                        "id": n,
+                        "organization": ORGANIZATION,
+                        "organization_subject_id": external_id,
+                        "first_name": f"First{n}",
+                        "last_name": f"Last{n}",
+                    }
+                )
+
+    @property
+    def field_names(self):
+        return [f["field_name"] for f in self.metadata] + [
+            f"{form}_complete" for form in self.forms
+        ]
+
+    def project_info(self):
+        return {
+            "project_id": self.project_id,
+            "project_title": "Synthetic benchmark project",
+            "is_longitudinal": 1,
+            "has_repeating_instruments_or_events": 1,
+        }
+
+    def form_event_mapping(self):
+        return [
+            {"arm_num": 1, "unique_event_name": EVENT, "form": form}
+            for form in self.forms
+        ]
+
+    def value(self, field, raw_value, label):
+        if label and raw_value in self.labels.get(field, {}):
+            return self.labels[field][raw_value]
+        return raw_value
+
+    def export_records(
+        self, records=None, fields=None, eav=False, label=False
+    ):
+        """Records in REDCap's flat or EAV JSON export format"""
+        wanted = set(fields) if fields else None
+        field_names = [
+            f for f in self.field_names if wanted is None or f in wanted
+        ]
+        out = []
+        for record_id in records or self.records:
+            for instrument, instance, values in self.records.get(
+                record_id, []
+            ):
+                base = {
+                    "record_id": record_id,
+                    "redcap_event_name": EVENT,
+                    "redcap_repeat_instrument": instrument,
+                    "redcap_repeat_instance": instance,
+                }
+                if eav:
+                    for field, raw_value in values.items():
+                        if wanted is None or field in wanted:
+                            out.append(
+                                {
+                                    "record": record_id,
+                                    "redcap_event_name": EVENT,
+                                    "redcap_repeat_instrument": instrument,
+                                    "redcap_repeat_instance": instance,
+                                    "field_name": field,
+                                    "value": self.value(
+                                        field, raw_value, label
+                                    ),
+                                }
+                            )
+                else:
+                    row = dict(base)
+                    for field in field_names:
+                        if field == "record_id":
+                            continue
+                        row[field] = self.value(
+                            field, values.get(field, ""), label
+                        )
+                    out.append(row)
+        return out
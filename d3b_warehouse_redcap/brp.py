@@ -1,27 +1,40 @@
 import logging
 import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pprint import pformat
-from d3b_warehouse_redcap.io import send_request
+from d3b_warehouse_redcap.io import (
+    RateLimiter,
+    iter_json_array,
+    preview,
+    send_request,
+)
+
+SUBJECT_ALREADY_EXISTS_ERROR_CODE = 400
 
 
 class BRP:
-    def __init__(self, api_url, api_token):
+    def __init__(self, api_url, api_token, transport=None):
         self.api_url = api_url
         self.api_token = api_token
+        # None means the shared default transport
+        self.transport = transport
 
-    def __request(self, method, endpoint, body=None):
+    def __request(self, method, endpoint, body=None, stream=False):
         """
-        Returns a JSON object of the HTTP request result.
+        Sends a request to the BRP and logs (the start of) its response.
 
             Parameters:
                 method (str): Method for the request object
                 endpoint (str): Endpoint for the request object
+                stream (bool): Leave the body unread, to be streamed
             Returns:
                 resp (object): Response object
         """
         headers = {
             "Content-Type": "application/json",
-            "Authorization": f"token {self.auth_token}",
+            "Authorization": f"token {self.api_token}",
         }
 
         resp = send_request(
@@ -31,21 +44,39 @@ class BRP:
             json=body,
             timeout=120,
             ignore_status_codes=[SUBJECT_ALREADY_EXISTS_ERROR_CODE],
+            transport=self.transport,
+            stream=stream,
         )
-        try:
-            body = pformat(resp.json())
-        except json.JSONDecodeError:
-            body = resp.text
 
-        # log body and status code, http method
+        # log status code, http method and the start of the body
         logging.info(
             "Response from BRP %s %s: %s",
             resp.request.method,
             resp.status_code,
-            body,
+            "(streamed)" if stream else preview(resp.content),
         )
         return resp
 
+    def iter_subjects(self, protocol_id):
+        """
+        Yields the subjects within a specific protocol as they are read from
+        the response, without holding the whole list.
+
+            Parameters:
+                protocol_id (int): Protocol ID
+            Returns:
+                subjects (iterator): Subjects associated with the protocol ID
+        """
+        resp = self.__request(
+            "GET", f"/protocols/{protocol_id}/subjects/", stream=True
+        )
+        count = 0
+        with resp:
+            for subject in iter_json_array(resp):
+                count += 1
+                yield subject
+        logging.info("Read %d subjects of BRP protocol %s", count, protocol_id)
+
     def get_subjects(self, protocol_id):
         """
         Returns a list of subjects within a specific protocol.
@@ -56,10 +87,8 @@ class BRP:
                 subject (list): Subjects associated with the protocol ID
         """
         try:
-            subjects = self.__request(
-                "GET", f"/protocols/{protocol_id}/subjects/"
-            ).json()
-        except json.JSONDecodeError:
+            subjects = list(self.iter_subjects(protocol_id))
+        except ValueError:
             subjects = None
         return subjects
 
@@ -108,6 +137,45 @@ class BRP:
             message = []
         return {"sent": data, "response": [created, body, message]}
 
+    def create_subjects(
+        self,
+        protocol_id,
+        subjects,
+        max_workers=1,
+        max_requests_per_second=None,
+    ):
+        """
+        Creates many subjects concurrently with a bounded pool of workers.
+
+            Parameters:
+                protocol_id (int): Protocol ID
+                subjects (list): create_subject keyword arguments (without
+                    protocol_id) for each subject
+                max_workers (int): Most create requests in flight at once
+                max_requests_per_second (float): Cap on how fast requests are
+                    started (None for no cap)
+            Returns:
+                results (list): (result, error) for each subject, in the same
+                    order as subjects. result is what create_subject returned
+                    and error is None, or result is None and error is the
+                    exception that was raised.
+        """
+        limiter = RateLimiter(max_requests_per_second)
+
+        def create(kwargs):
+            limiter.wait()
+            return self.create_subject(protocol_id=protocol_id, **kwargs)
+
+        results = []
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            futures = [pool.submit(create, s) for s in subjects]
+            for f in futures:
+                try:
+                    results.append((f.result(), None))
+                except Exception as e:
+                    results.append((None, e))
+        return results
+
 
 def extract_brp_create_subj_response(response: dict) -> tuple:
     if (
@@ -121,13 +189,123 @@ def extract_brp_create_subj_response(response: dict) -> tuple:
         logging.info(
             " Create Subject matches expected structure, %s %s %s",
             created,
-            pformat(body),
-            pformat(message),
+            preview(pformat(body)),
+            preview(pformat(message)),
         )
         return created, body, message
 
     logging.warning(
         "Create subject response doesn't match expected structure %s",
-        pformat(response),
+        preview(pformat(response)),
     )
     return False, {}, []
+
+
+class SubjectIndexCache:
+    """
+    On-disk copy of a BRP protocol's (organization, organization_subject_id)
+    -> eHB id index, so that runs don't have to download the whole subject
+    list every time. Entries older than ttl seconds are ignored.
+
+    Loaded indexes are also kept in memory until the file changes, so
+    long-running processes don't re-read it every run.
+    """
+
+    # path -> (file mtime_ns, fetched_at, index)
+    _loaded = {}
+
+    def __init__(self, cache_dir, protocol_id, ttl=24 * 60 * 60):
+        self.path = os.path.join(
+            cache_dir, f"brp_protocol_{protocol_id}_subjects.json"
+        )
+        self.ttl = ttl
+
+    def load(self):
+        """Returns the cached index, or None if it's missing or expired"""
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+            loaded = self._loaded.get(self.path)
+            if loaded is None or loaded[0] != mtime:
+                with open(self.path) as f:
+                    cached = json.load(f)
+                loaded = (
+                    mtime,
+                    cached["fetched_at"],
+                    {
+                        (org, org_id): id
+                        for org, org_id, id in cached["subjects"]
+                    },
+                )
+                self._loaded[self.path] = loaded
+        except (OSError, ValueError):
+            return None
+        if time.time() - loaded[1] > self.ttl:
+            return None
+        return dict(loaded[2])
+
+    def save(self, index, fetched_at=None):
+        os.makedirs(
+            os.path.dirname(self.path) or ".", mode=0o700, exist_ok=True
+        )
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        # the index maps organization IDs (e.g. MRNs) to subjects, so only
+        # its owner may read it
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        os.fchmod(fd, 0o600)
+        with os.fdopen(fd, "w") as f:
+            json.dump(
+                {
+                    "fetched_at": fetched_at or time.time(),
+                    "subjects": [
+                        [org, org_id, id]
+                        for (org, org_id), id in index.items()
+                    ],
+                },
+                f,
+            )
+        os.replace(tmp, self.path)
+
+    def add(self, entries):
+        """Add newly created subjects to a still-fresh cached index"""
+        try:
+            with open(self.path) as f:
+                fetched_at = json.load(f)["fetched_at"]
+        except (OSError, ValueError, KeyError):
+            return
+        index = self.load()
+        if index is not None:
+            index.update(entries)
+            self.save(index, fetched_at)
+
+    def invalidate(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def get_subject_index(brp, protocol_id, cache=None, refresh=False):
+    """
+    Returns a protocol's (organization, organization_subject_id) -> eHB id
+    index, from the cache if it's fresh and otherwise from the BRP.
+
+        Parameters:
+            brp (BRP): BRP client
+            protocol_id (int): Protocol ID
+            cache (SubjectIndexCache): Optional on-disk cache
+            refresh (bool): Skip the cache and download the index
+        Returns:
+            index (dict): eHB ids
+            from_cache (bool): Whether the index came from the cache
+    """
+    if cache is not None and not refresh:
+        index = cache.load()
+        if index is not None:
+            return index, True
+
+    fetched_at = time.time()
+    index = {
+        (bs["organization"], bs["organization_subject_id"]): bs["id"]
+        for bs in brp.iter_subjects(protocol_id)
+    }
+    if cache is not None:
+        cache.save(index, fetched_at)
+    return index, False
@@ -0,0 +1,202 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+
+from pandas import DataFrame, read_parquet, read_pickle
+from pandas.util import hash_pandas_object
+
+# Pipeline stages that get checkpointed, in order
+STAGES = ("extract", "cids", "deidentified")
+
+
+def content_hash(dfs):
+    """Stable hash of a dict of DataFrames' names, columns and values"""
+    h = hashlib.sha256()
+    for name in sorted(dfs):
+        df = dfs[name]
+        h.update(name.encode())
+        h.update(json.dumps([str(c) for c in df.columns]).encode())
+        h.update(hash_pandas_object(df, index=True).values.tobytes())
+    return h.hexdigest()
+
+
+def _write_df(df, path):
+    """
+    Write df as compressed Parquet, or as a gzipped pickle when pyarrow isn't
+    installed or can't represent the columns (e.g. mixed-type objects).
+    """
+    try:
+        df.to_parquet(path + ".parquet", compression="zstd")
+        return
+    except ImportError:
+        pass
+    except (ValueError, TypeError, NotImplementedError) as e:
+        # pyarrow's ArrowNotImplementedError is a NotImplementedError
+        logging.info("Checkpointing %s as pickle: %s", path, e)
+        if os.path.exists(path + ".parquet"):
+            os.remove(path + ".parquet")
+    df.to_pickle(path + ".pkl.gz")
+
+
+def _read_df(path):
+    if os.path.exists(path + ".parquet"):
+        return read_parquet(path + ".parquet")
+    return read_pickle(path + ".pkl.gz")
+
+
+class Checkpoint:
+    """
+    One run's intermediate DataFrames on local disk, one directory per
+    completed stage, with a manifest of what has been saved.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.manifest_path = os.path.join(path, "manifest.json")
+        try:
+            with open(self.manifest_path) as f:
+                self.manifest = json.load(f)
+        except OSError:
+            self.manifest = {"created": time.time(), "stages": {}}
+
+    @property
+    def stages(self):
+        """Completed stages, in pipeline order"""
+        return [s for s in STAGES if s in self.manifest["stages"]]
+
+    @property
+    def last_stage(self):
+        return (self.stages or [None])[-1]
+
+    @property
+    def complete(self):
+        return self.manifest.get("complete", False)
+
+    @property
+    def metadata(self):
+        return self.manifest.get("metadata", {})
+
+    def _save_manifest(self):
+        os.makedirs(self.path, exist_ok=True)
+        tmp = self.manifest_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.manifest, f, default=str)
+        os.replace(tmp, self.manifest_path)
+
+    def save(self, stage, dfs=None, lookups=None):
+        """
+        Save a stage's DataFrames (if any) and small named lookup tables
+        (DataFrames or JSON-able values). A stage saved without DataFrames
+        reuses those of the stage before it when loaded.
+        """
+        stage_dir = os.path.join(self.path, stage)
+        if os.path.exists(stage_dir):
+            shutil.rmtree(stage_dir)
+        os.makedirs(stage_dir)
+        for name, df in (dfs or {}).items():
+            _write_df(df, os.path.join(stage_dir, name))
+        saved_lookups = {}
+        for name, value in (lookups or {}).items():
+            if isinstance(value, DataFrame):
+                _write_df(value, os.path.join(stage_dir, f"_lookup_{name}"))
+                saved_lookups[name] = None
+            else:
+                saved_lookups[name] = value
+        self.manifest["stages"][stage] = {
+            "saved": time.time(),
+            "tables": list(dfs or {}),
+            "lookups": saved_lookups,
+        }
+        self._save_manifest()
+
+    def load(self, stage):
+        """Returns the DataFrames saved at (or last saved before) a stage"""
+        for s in reversed(STAGES[: STAGES.index(stage) + 1]):
+            info = self.manifest["stages"].get(s)
+            if info and info["tables"]:
+                return {
+                    name: _read_df(os.path.join(self.path, s, name))
+                    for name in info["tables"]
+                }
+        return {}
+
+    def lookups(self, stage):
+        info = self.manifest["stages"][stage]
+        return {
+            name: (
+                _read_df(os.path.join(self.path, stage, f"_lookup_{name}"))
+                if value is None
+                else value
+            )
+            for name, value in info["lookups"].items()
+        }
+
+    def mark_complete(self):
+        self.manifest["complete"] = True
+        self._save_manifest()
+
+
+class CheckpointStore:
+    """
+    Checkpoints kept under root/redcap_<project_id>/<content hash>, keeping
+    only the `keep` most recent per project.
+    """
+
+    def __init__(self, root, keep=3):
+        self.root = root
+        self.keep = keep
+
+    def _project_dir(self, project_id):
+        return os.path.join(self.root, f"redcap_{project_id}")
+
+    def _checkpoints(self, project_id):
+        """Existing checkpoints for a project, newest first"""
+        project_dir = self._project_dir(project_id)
+        if not os.path.isdir(project_dir):
+            return []
+        found = [
+            Checkpoint(os.path.join(project_dir, d))
+            for d in os.listdir(project_dir)
+            if os.path.exists(os.path.join(project_dir, d, "manifest.json"))
+        ]
+        return sorted(found, key=lambda c: c.manifest["created"], reverse=True)
+
+    def create(self, project_id, dfs, metadata=None):
+        """Start a checkpoint for a run whose raw extract is dfs"""
+        path = os.path.join(
+            self._project_dir(project_id), content_hash(dfs)[:16]
+        )
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        checkpoint = Checkpoint(path)
+        checkpoint.manifest["metadata"] = metadata or {}
+        checkpoint._save_manifest()
+        for old in self._checkpoints(project_id)[self.keep :]:
+            shutil.rmtree(old.path, ignore_errors=True)
+        return checkpoint
+
+    def latest_incomplete(self, project_id, max_age=None):
+        """
+        The newest checkpoint for a project if its run never finished and it
+        was started less than max_age seconds ago (any age if None). Stale
+        checkpoints are left for --replay_checkpoint. Checkpoints that failed
+        before saving any stage are removed.
+        """
+        for checkpoint in self._checkpoints(project_id):
+            if checkpoint.complete:
+                return None
+            if checkpoint.stages:
+                age = time.time() - checkpoint.manifest["created"]
+                if max_age is not None and age > max_age:
+                    logging.info(
+                        "Not resuming %s, started %.1f hours ago",
+                        checkpoint.path,
+                        age / 3600,
+                    )
+                    return None
+                return checkpoint
+            shutil.rmtree(checkpoint.path, ignore_errors=True)
+        return None
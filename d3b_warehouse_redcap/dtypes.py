@@ -0,0 +1,149 @@
+import logging
+from collections import namedtuple
+
+from pandas import CategoricalDtype, to_datetime, to_numeric
+from sqlalchemy import Date, DateTime, Enum
+
+# What a column holds in memory (a pandas dtype) and in the warehouse (a
+# SQLAlchemy type, or None to let pandas pick one from the dtype)
+ColumnType = namedtuple("ColumnType", ["dtype", "sql"])
+
+# Single-choice field types, whose values are exported as choice labels
+CHOICE_FIELD_TYPES = ("radio", "dropdown", "yesno", "truefalse")
+FIXED_CHOICES = {"yesno": ["No", "Yes"], "truefalse": ["False", "True"]}
+
+# Columns that redcap_safe_dates derives from each date field
+YEAR_SUFFIX = "_year"
+AGE_SUFFIX = "_as_age"
+
+
+def _validation_type(validation):
+    """Returns the ColumnType for a text field's validation, or None"""
+    if validation == "integer":
+        return ColumnType("Int64", None)
+    if validation == "number" or (
+        validation.startswith("number_") and "comma" not in validation
+    ):
+        return ColumnType("Float64", None)
+    if validation.startswith("datetime"):
+        return ColumnType("datetime64[ns]", DateTime)
+    if validation.startswith("date"):
+        return ColumnType("datetime64[ns]", Date)
+    return None
+
+
+def field_column_types(data_dictionary, choice_map=None):
+    """
+    Returns {column: ColumnType} for the columns that REDCap fields become,
+    from each field's type, text validation and choice list.
+
+        Parameters:
+            data_dictionary (list): from REDCapStudy.get_data_dictionary
+            choice_map (dict): from REDCapStudy.get_selector_choice_map
+    """
+    choice_map = choice_map or {}
+    types = {}
+    for d in data_dictionary:
+        field = d["field_name"]
+        field_type = d["field_type"]
+        validation = d["text_validation_type_or_show_slider_number"] or ""
+
+        if field_type in CHOICE_FIELD_TYPES:
+            labels = list(choice_map.get(field, {}).values())
+            labels = labels or FIXED_CHOICES.get(field_type)
+            if labels:
+                types[field] = ColumnType(
+                    CategoricalDtype(list(dict.fromkeys(labels))), None
+                )
+        elif field_type == "calc":
+            types[field] = ColumnType("Float64", None)
+        elif field_type == "slider":
+            types[field] = ColumnType("Int16", None)
+        elif field_type == "notes":
+            types[field] = ColumnType("string", None)
+        elif field_type == "text":
+            types[field] = _validation_type(validation) or ColumnType(
+                "string", None
+            )
+            if validation.startswith("date"):
+                types[field + YEAR_SUFFIX] = ColumnType("Int16", None)
+                types[field + AGE_SUFFIX] = ColumnType("Int32", None)
+    return types
+
+
+def _cast(s, dtype):
+    """
+    Returns s as dtype, or raises ValueError if any of its values would be
+    lost doing so. Choice labels missing from a categorical dtype are added
+    to its categories. Empty strings become NULL in every type except text,
+    where they are kept as exported.
+    """
+    if dtype == "string":
+        return s.astype(dtype)
+
+    s = s.where(s.notna() & (s != ""), None)
+    present = s.notna()
+
+    if isinstance(dtype, CategoricalDtype):
+        extra = set(s[present]) - set(dtype.categories)
+        if extra:
+            dtype = CategoricalDtype(
+                list(dtype.categories) + sorted(extra, key=str)
+            )
+        return s.astype(dtype)
+    if dtype.startswith("datetime"):
+        cast = to_datetime(s, errors="coerce")
+    else:
+        cast = to_numeric(s, errors="coerce")
+    if (cast.isna() & present).any():
+        raise ValueError("values that don't parse")
+    try:
+        return cast.astype(dtype)
+    except TypeError as e:
+        # e.g. decimals in an integer field
+        raise ValueError(str(e))
+
+
+def apply_column_types(df, column_types):
+    """
+    Cast df's columns in place to their ColumnTypes. Columns with values
+    that don't fit their type are left alone.
+
+        Returns:
+            typed (list): the columns that were cast
+    """
+    typed = []
+    for c in df.columns:
+        t = column_types.get(c)
+        if t is None:
+            continue
+        try:
+            df[c] = _cast(df[c], t.dtype)
+            typed.append(c)
+        except ValueError as e:
+            logging.warning("Leaving %s untyped (%s): %s", c, t.dtype, e)
+    return typed
+
+
+def sql_column_types(df, column_types):
+    """
+    Returns the to_sql dtype argument for df: dates as DATE or TIMESTAMP and
+    choice fields as strings constrained to their choices. Other columns get
+    the SQL types pandas picks for their (already compact) dtypes.
+    """
+    sql = {}
+    for c in df.columns:
+        t = column_types.get(c)
+        if t is None:
+            continue
+        if isinstance(df[c].dtype, CategoricalDtype):
+            labels = [str(v) for v in df[c].cat.categories]
+            sql[c] = Enum(
+                *labels,
+                native_enum=False,
+                create_constraint=True,
+                length=max(map(len, labels), default=1),
+            )
+        elif t.sql is not None and str(df[c].dtype).startswith("datetime"):
+            sql[c] = t.sql
+    return sql
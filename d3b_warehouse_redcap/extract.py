@@ -0,0 +1,359 @@
+import gzip
+import hashlib
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from d3b_redcap_api.df_utils import all_dfs
+
+from d3b_warehouse_redcap.io import send_request
+
+# REDCap compares dateRangeBegin against its own server clock, so back the
+# watermark off a little to cover clock skew and in-flight saves. Records
+# saved inside the overlap just get exported twice.
+WATERMARK_OVERLAP = timedelta(hours=1)
+REDCAP_DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# seconds before the first retry of a failed batch export, doubling each time
+BATCH_RETRY_BACKOFF = 2
+
+
+def metadata_fingerprint(data_dictionary):
+    """Stable hash of a REDCap data dictionary"""
+    return hashlib.sha256(
+        json.dumps(data_dictionary, sort_keys=True).encode()
+    ).hexdigest()
+
+
+def export_record_ids(
+    api_url, api_token, record_id_field, modified_since=None, transport=None
+):
+    """
+    Returns the IDs of the records in a REDCap project, in export order.
+
+        Parameters:
+            api_url (str): REDCap API url
+            api_token (str): REDCap project API token
+            record_id_field (str): The project's record ID field
+            modified_since (datetime): Only list records created or modified
+                at or after this time
+        Returns:
+            ids (list): Record IDs
+    """
+    data = {
+        "token": api_token,
+        "content": "record",
+        "format": "json",
+        "type": "flat",
+        "fields[0]": record_id_field,
+        "returnFormat": "json",
+    }
+    if modified_since is not None:
+        data["dateRangeBegin"] = modified_since.strftime(
+            REDCAP_DATETIME_FORMAT
+        )
+
+    resp = send_request(
+        "post",
+        api_url,
+        headers={"Accept": "application/json"},
+        data=data,
+        timeout=None,
+        transport=transport,
+    )
+    return list(dict.fromkeys(str(r[record_id_field]) for r in resp.json()))
+
+
+def export_records_tree(rs, records):
+    """Returns (records_tree, errors) for just the given REDCap record IDs"""
+    return rs.get_records_tree(records=list(records))
+
+
+def export_records_tree_batched(
+    rs, records, batch_size=500, max_workers=4, retries=2
+):
+    """
+    Returns (records_tree, errors) for the given REDCap record IDs, exported
+    in batches of batch_size over max_workers concurrent requests and
+    assembled in record order.
+
+    A batch whose export raises is retried on its own, up to retries more
+    times, after the others finish. Batches that still fail are reported in
+    errors along with any errors REDCap returned.
+    """
+    records = list(records)
+    batches = [
+        records[i : i + batch_size] for i in range(0, len(records), batch_size)
+    ]
+    results = [None] * len(batches)
+
+    def export(i):
+        try:
+            results[i] = export_records_tree(rs, batches[i])
+            return True
+        except Exception as e:
+            logging.warning(
+                "REDCap export of batch %d/%d failed: %s",
+                i + 1,
+                len(batches),
+                e,
+            )
+            return False
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        exported = list(pool.map(export, range(len(batches))))
+    failed = [i for i, ok in enumerate(exported) if not ok]
+    for attempt in range(retries):
+        if not failed:
+            break
+        time.sleep(BATCH_RETRY_BACKOFF * 2 ** attempt)
+        logging.warning(
+            "Retrying %d failed REDCap export batches...", len(failed)
+        )
+        failed = [i for i in failed if not export(i)]
+
+    tree, errors = {}, []
+    for subtree, batch_errors in filter(None, results):
+        tree.update(subtree)
+        if batch_errors:
+            errors.append(batch_errors)
+    for i in failed:
+        errors.append(
+            f"REDCap export of records {batches[i][0]} to {batches[i][-1]}"
+            f" failed after {retries} retries"
+        )
+    logging.info(
+        "Exported %d REDCap records in %d batches", len(records), len(batches)
+    )
+    return tree, errors
+
+
+def get_records_tree_batched(
+    rs,
+    api_url,
+    api_token,
+    record_id_field,
+    batch_size=500,
+    max_workers=4,
+    retries=2,
+    transport=None,
+):
+    """
+    Returns (records_tree, errors) like REDCapStudy.get_records_tree, but
+    lists the project's record IDs first and then exports them with
+    export_records_tree_batched.
+    """
+    ids = export_record_ids(
+        api_url, api_token, record_id_field, transport=transport
+    )
+    return export_records_tree_batched(
+        rs, ids, batch_size, max_workers, retries
+    )
+
+
+def tree_instruments(records_tree):
+    """Returns the instruments in a records tree, in the order first seen"""
+    instruments = {}
+    for events in records_tree.values():
+        for event_instruments in events.values():
+            instruments.update(dict.fromkeys(event_instruments))
+    return list(instruments)
+
+
+def pop_instrument_df(records_tree, instrument):
+    """
+    Returns the DataFrame that all_dfs makes for one instrument of a
+    records tree ({subject: {event: {instrument: ...}}}), taking that
+    instrument's records out of the tree so their memory can be freed.
+    Returns None if the instrument has no records.
+    """
+    subtree = {}
+    for subject, events in records_tree.items():
+        for event, event_instruments in events.items():
+            if instrument in event_instruments:
+                subtree.setdefault(subject, {})[event] = {
+                    instrument: event_instruments.pop(instrument)
+                }
+    if not subtree:
+        return None
+    return all_dfs(subtree).get(instrument)
+
+
+# Stands in for a dict with non-string keys (e.g. repeat instance numbers) in
+# a records tree saved as JSON: {ITEMS_KEY: [[key, value], ...]}
+ITEMS_KEY = "__items__"
+
+
+def _encode_tree(node):
+    """Returns a records tree (or any node of one) as JSON-able values"""
+    if not isinstance(node, dict):
+        return node
+    if all(isinstance(k, str) for k in node):
+        return {k: _encode_tree(v) for k, v in node.items()}
+    return {ITEMS_KEY: [[k, _encode_tree(v)] for k, v in node.items()]}
+
+
+def _decode_node(obj):
+    """json object_hook undoing _encode_tree"""
+    if list(obj) == [ITEMS_KEY]:
+        return {
+            tuple(k) if isinstance(k, list) else k: v
+            for k, v in obj[ITEMS_KEY]
+        }
+    return obj
+
+
+def _open_private(path, mode):
+    """open() for a file that only its owner can read or write"""
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    os.fchmod(fd, 0o600)
+    return os.fdopen(fd, mode)
+
+
+class RecordsSnapshot:
+    """
+    The last records tree extracted from a REDCap project, stored on local
+    disk as gzipped JSON along with the watermark time it was current as of.
+    The tree holds PHI, so it is only readable by its owner.
+    """
+
+    def __init__(self, state_dir, project_id):
+        self.state_dir = state_dir
+        self.dir = os.path.join(state_dir, f"redcap_{project_id}")
+        self.tree_path = os.path.join(self.dir, "records_tree.json.gz")
+        self.watermark_path = os.path.join(self.dir, "watermark.json")
+        # written by earlier versions, and never unpickled
+        self.legacy_tree_path = os.path.join(
+            self.dir, "records_tree.pickle.gz"
+        )
+
+    def load(self):
+        """
+        Returns (records_tree, watermark) or (None, None) if there is no
+        usable snapshot. watermark is a dict with the "time" of the snapshot
+        and the data dictionary "fingerprint" it was extracted under.
+        """
+        try:
+            with open(self.watermark_path) as f:
+                watermark = json.load(f)
+            watermark["time"] = datetime.fromisoformat(watermark["time"])
+            with gzip.open(self.tree_path, "rt") as f:
+                tree = json.load(f, object_hook=_decode_node)
+        except (OSError, ValueError, KeyError, EOFError):
+            return None, None
+        return tree, watermark
+
+    def save(self, tree, time, fingerprint):
+        for d in (self.state_dir, self.dir):
+            os.makedirs(d, mode=0o700, exist_ok=True)
+            os.chmod(d, 0o700)
+        # write the tree first so a crash can't leave a watermark that points
+        # past what was actually stored
+        tmp = self.tree_path + ".tmp"
+        with _open_private(tmp, "wb") as raw, gzip.open(raw, "wt") as f:
+            json.dump(_encode_tree(tree), f)
+        os.replace(tmp, self.tree_path)
+        if os.path.exists(self.legacy_tree_path):
+            os.remove(self.legacy_tree_path)
+        tmp = self.watermark_path + ".tmp"
+        with _open_private(tmp, "w") as f:
+            json.dump(
+                {"time": time.isoformat(), "fingerprint": fingerprint}, f
+            )
+        os.replace(tmp, self.watermark_path)
+
+    def clear(self):
+        for path in (
+            self.watermark_path,
+            self.tree_path,
+            self.legacy_tree_path,
+        ):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def get_records_tree_incremental(
+    rs,
+    api_url,
+    api_token,
+    data_dictionary,
+    snapshot,
+    full_refresh=False,
+    transport=None,
+    batch_size=None,
+    max_workers=4,
+    retries=2,
+):
+    """
+    Returns (records_tree, errors) like REDCapStudy.get_records_tree, but
+    only exports the records modified since the last successful run and
+    merges them into that run's snapshot.
+
+    Falls back to a full export when asked to, when there is no snapshot yet,
+    or when the data dictionary has changed since the snapshot was taken.
+    With a batch_size, exports go through export_records_tree_batched.
+    """
+    started = datetime.now()
+    fingerprint = metadata_fingerprint(data_dictionary)
+    record_id_field = data_dictionary[0]["field_name"]
+
+    tree, watermark = (None, None) if full_refresh else snapshot.load()
+    if tree is not None and watermark["fingerprint"] != fingerprint:
+        logging.info(
+            "REDCap metadata changed since the last run. Full refresh."
+        )
+        tree = None
+
+    if tree is None:
+        logging.info("Exporting all REDCap records...")
+        if batch_size:
+            tree, errors = get_records_tree_batched(
+                rs,
+                api_url,
+                api_token,
+                record_id_field,
+                batch_size,
+                max_workers,
+                retries,
+                transport,
+            )
+        else:
+            tree, errors = rs.get_records_tree()
+    else:
+        since = watermark["time"] - WATERMARK_OVERLAP
+        changed = export_record_ids(
+            api_url, api_token, record_id_field, since, transport
+        )
+        current = set(
+            export_record_ids(
+                api_url, api_token, record_id_field, transport=transport
+            )
+        )
+        deleted = [k for k in tree if str(k) not in current]
+        logging.info(
+            "Incremental REDCap export since %s: %d changed records, %d"
+            " deleted records",
+            since,
+            len(changed),
+            len(deleted),
+        )
+        for k in deleted:
+            del tree[k]
+        errors = None
+        if changed and batch_size:
+            subtree, errors = export_records_tree_batched(
+                rs, changed, batch_size, max_workers, retries
+            )
+            tree.update(subtree)
+        elif changed:
+            subtree, errors = export_records_tree(rs, changed)
+            tree.update(subtree)
+
+    if errors:
+        logging.warning("Not saving REDCap snapshot because of errors")
+    else:
+        snapshot.save(tree, started, fingerprint)
+    return tree, errors
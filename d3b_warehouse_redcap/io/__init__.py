@@ -1,17 +1,264 @@
 from __future__ import annotations
+import codecs
 import logging
 import requests
 import json
+import threading
+import time
 from pprint import pformat
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.util.retry import Retry
 
 TIMEOUT_INFINITY = -1
 
+# Most characters of a response body that get logged
+LOG_BODY_LIMIT = 2000
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# Only methods that are safe to send twice get retried after a read error or
+# a transient server error. Connection failures are retried for any method
+# because the request never reached the server.
+IDEMPOTENT_METHODS = frozenset(
+    ["HEAD", "GET", "PUT", "DELETE", "OPTIONS", "TRACE"]
+)
+RETRY_STATUS_CODES = (500, 502, 503, 504)
+
+
+class _CountingRetry(Retry):
+    """urllib3 Retry that reports every retry it allows to a callback"""
+
+    def __init__(self, *args, on_retry=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.on_retry = on_retry
+
+    def new(self, **kw):
+        retry = super().new(**kw)
+        retry.on_retry = self.on_retry
+        return retry
+
+    def increment(self, *args, **kwargs):
+        # raises MaxRetryError when we're out of retries
+        retry = super().increment(*args, **kwargs)
+        if self.on_retry:
+            self.on_retry()
+        return retry
+
+
+def _counting_pool(base, on_acquire):
+    """
+    Returns a subclass of the urllib3 pool class base that calls
+    on_acquire(reused) each time it hands out a connection, with whether
+    that connection was already open
+    """
+
+    class CountingPool(base):
+        def _get_conn(self, timeout=None):
+            conn = super()._get_conn(timeout=timeout)
+            on_acquire(getattr(conn, "sock", None) is not None)
+            return conn
+
+    return CountingPool
+
+
+class Transport:
+    """
+    A shared requests.Session with keep-alive connection pooling and
+    exponential-backoff retries. Clients that share a Transport reuse each
+    other's open connections.
+    """
+
+    def __init__(
+        self,
+        pool_maxsize=10,
+        retries=3,
+        backoff_factor=0.5,
+        retry_status_codes=RETRY_STATUS_CODES,
+    ):
+        self._lock = threading.Lock()
+        self._requests = 0
+        self._retries = 0
+        self._connections = {"opened": 0, "reused": 0}
+        retry = _CountingRetry(
+            total=retries,
+            connect=retries,
+            read=retries,
+            status=retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=retry_status_codes,
+            allowed_methods=IDEMPOTENT_METHODS,
+            raise_on_status=False,
+            on_retry=self._count_retry,
+        )
+        self.adapter = HTTPAdapter(
+            pool_connections=pool_maxsize,
+            pool_maxsize=pool_maxsize,
+            max_retries=retry,
+        )
+        self.adapter.poolmanager.pool_classes_by_scheme = {
+            "http": _counting_pool(HTTPConnectionPool, self._count_connection),
+            "https": _counting_pool(
+                HTTPSConnectionPool, self._count_connection
+            ),
+        }
+        self.session = requests.Session()
+        self.session.mount("http://", self.adapter)
+        self.session.mount("https://", self.adapter)
+
+    def _count_retry(self):
+        with self._lock:
+            self._retries += 1
+
+    def _count_connection(self, reused):
+        with self._lock:
+            self._connections["reused" if reused else "opened"] += 1
+
+    def request(self, method, *args, **kwargs):
+        with self._lock:
+            self._requests += 1
+        return self.session.request(method.upper(), *args, **kwargs)
+
+    def stats(self):
+        """
+        Returns counts of requests sent, retries made, and connections opened
+        vs reused since this Transport was created. Each attempt, retries
+        included, takes a connection from the pool, and counts as opening or
+        reusing one.
+        """
+        with self._lock:
+            return {
+                "requests": self._requests,
+                "retries": self._retries,
+                "connections_opened": self._connections["opened"],
+                "connections_reused": self._connections["reused"],
+            }
+
+    def close(self):
+        self.session.close()
+
+
+_default_transport = None
+_default_transport_lock = threading.Lock()
+
+# Callables notified as fn(method, url, status_code, seconds) after every
+# send_request (status_code is 0 if no response came back)
+_request_observers = []
+
+
+def add_request_observer(fn):
+    _request_observers.append(fn)
+
+
+def remove_request_observer(fn):
+    if fn in _request_observers:
+        _request_observers.remove(fn)
+
+
+def _notify_request_observers(method, url, status_code, seconds):
+    for fn in list(_request_observers):
+        try:
+            fn(method, url, status_code, seconds)
+        except Exception:
+            logging.exception("Request observer failed")
+
+
+def default_transport() -> Transport:
+    """Returns the process-wide Transport, creating it on first use"""
+    global _default_transport
+    with _default_transport_lock:
+        if _default_transport is None:
+            _default_transport = Transport()
+        return _default_transport
+
+
+def set_default_transport(transport: Transport):
+    """Replace the process-wide Transport (e.g. to change pool or retries)"""
+    global _default_transport
+    with _default_transport_lock:
+        _default_transport = transport
+
+
+class RateLimiter:
+    """
+    Spaces out calls to wait() so that no more than `rate` of them return per
+    second, across all threads sharing the limiter. A rate of None (or 0)
+    disables the limit.
+    """
+
+    def __init__(self, rate=None):
+        self.interval = 1.0 / rate if rate else 0
+        self._lock = threading.Lock()
+        self._next = time.monotonic()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+def preview(content, limit=LOG_BODY_LIMIT):
+    """Returns at most limit characters of a response body for logging"""
+    if isinstance(content, bytes):
+        text = content[:limit].decode("utf-8", errors="replace")
+    else:
+        text = content[:limit]
+    if len(content) > limit:
+        text += f"... ({len(content)} in all)"
+    return text
+
+
+def iter_json_array(resp, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Yields the elements of a response body that is a JSON array as they are
+    read (send the request with stream=True), so only one element at a time
+    is held rather than the whole body and structure.
+
+    Raises ValueError if the body isn't a complete JSON array.
+    """
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder(resp.encoding or "utf-8")()
+    buf, pos, started = "", 0, False
+    for chunk in resp.iter_content(chunk_size=chunk_size):
+        buf = buf[pos:] + text.decode(chunk)
+        pos = 0
+        while True:
+            while pos < len(buf) and buf[pos] in " \t\r\n,":
+                pos += 1
+            if pos == len(buf):
+                break
+            if not started:
+                if buf[pos] != "[":
+                    raise ValueError("Response body isn't a JSON array")
+                started = True
+                pos += 1
+                continue
+            if buf[pos] == "]":
+                return
+            try:
+                item, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                break  # the element isn't all here yet
+            if not isinstance(item, (dict, list, str)) and (
+                buf[end : end + 1] not in ("", " ", "\t", "\r", "\n", ",", "]")
+                or end == len(buf)
+            ):
+                break  # a number may continue in the next chunk
+            yield item
+            pos = end
+    raise ValueError("Response body ended inside a JSON array")
+
 
 def send_request(
     method: str,
     *args: any,
     ignore_status_codes: list[str] = None,
     timeout=TIMEOUT_INFINITY,
+    transport: Transport = None,
     **kwargs: any,
 ) -> requests.Response:
     """
@@ -23,6 +270,8 @@ def send_request(
         *args: positional arguments passed to request method
         ignore_status_codes: list of HTTP status codes to ignore in the
         response
+        transport: Transport to send the request over (defaults to the
+        shared process-wide one)
         **kwargs:
 
     Returns:
@@ -44,30 +293,40 @@ def send_request(
     elif timeout == TIMEOUT_INFINITY:
         kwargs["timeout"] = None
 
+    else:
+        kwargs["timeout"] = timeout
+
     logging.info(
         "⌚️ Applying timeout: %s (connect, read)" " seconds to request", timeout
     )
 
-    # Get http method
-    requests_op = getattr(requests, method.lower())
+    transport = transport or default_transport()
     status_code = 0
+    start = time.perf_counter()
     try:
-        resp = requests_op(*args, **kwargs)
-        status_code = resp.status_code
+        try:
+            resp = transport.request(method, *args, **kwargs)
+            status_code = resp.status_code
+        finally:
+            _notify_request_observers(
+                method,
+                args[0] if args else kwargs.get("url"),
+                status_code,
+                time.perf_counter() - start,
+            )
         resp.raise_for_status()
     except requests.exceptions.HTTPError as e:
         # User said to ignore this status code so pass
-        kwargs["headers"]["Authorization"] = "Token ****"
+        if "headers" in kwargs:
+            kwargs["headers"]["Authorization"] = "Token ****"
+        if isinstance(kwargs.get("data"), dict) and "token" in kwargs["data"]:
+            kwargs["data"] = {**kwargs["data"], "token": "****"}
 
         if ignore_status_codes and (status_code in ignore_status_codes):
             pass
         # Error that we need to log and raise
         else:
-            body = "No request body found"
-            try:
-                body = pformat(resp.json())
-            except json.JSONDecodeError:
-                body = resp.text
+            body = preview(resp.content) or "No request body found"
 
             raise requests.exceptions.HTTPError(
                 f"❌ Problem sending {method} request to server\n"
@@ -0,0 +1,174 @@
+import hashlib
+import json
+import logging
+import os
+from functools import cached_property
+
+# Field types whose select_choices_or_calculations is a "raw, label | ..."
+# choice list
+SELECTOR_FIELD_TYPES = ("radio", "dropdown", "checkbox")
+
+# derived lookups already built in this process, by metadata fingerprint
+_derived = {}
+
+
+def parse_choices(choices):
+    """Returns {raw value: label} from a REDCap "1, One | 2, Two" choice list"""
+    parsed = {}
+    for choice in (choices or "").split("|"):
+        raw, sep, label = choice.partition(",")
+        if sep:
+            parsed[raw.strip()] = label.strip()
+    return parsed
+
+
+def derive(data_dictionary, instrument_event_mappings):
+    """The field lists and lookups the pipeline builds from the metadata"""
+    validation = "text_validation_type_or_show_slider_number"
+    form_events = {}
+    for m in instrument_event_mappings:
+        form_events.setdefault(m["form"], m["unique_event_name"])
+    return {
+        "record_id_field": data_dictionary[0]["field_name"],
+        "identifier_fields": [
+            d["field_name"] for d in data_dictionary if d["identifier"]
+        ],
+        "date_fields": [
+            d["field_name"]
+            for d in data_dictionary
+            if "date" in (d[validation] or "")
+        ],
+        "note_fields": [
+            d["field_name"]
+            for d in data_dictionary
+            if d["field_type"] == "notes"
+        ],
+        "field_forms": {
+            d["field_name"]: d["form_name"] for d in data_dictionary
+        },
+        "form_events": form_events,
+        "choice_map": {
+            d["field_name"]: parse_choices(d["select_choices_or_calculations"])
+            for d in data_dictionary
+            if d["field_type"] in SELECTOR_FIELD_TYPES
+        },
+    }
+
+
+class ProjectMetadata:
+    """
+    A REDCap project's metadata, fetched at most once per run, and the
+    structures derived from it. The derived structures are cached in memory
+    and under cache_dir along with a fingerprint of the metadata, and only
+    rebuilt when that changes.
+
+    Already known metadata items (e.g. from a checkpoint) can be passed as
+    keyword arguments (project_info, data_dictionary,
+    instrument_event_mappings) to skip fetching them.
+    """
+
+    def __init__(self, rs, cache_dir=None, **known):
+        self.rs = rs
+        self.cache_dir = cache_dir
+        self.__dict__.update(known)
+
+    @cached_property
+    def project_info(self):
+        return self.rs.get_project_info()
+
+    @cached_property
+    def data_dictionary(self):
+        return self.rs.get_data_dictionary()
+
+    @cached_property
+    def instrument_event_mappings(self):
+        # classic (non-longitudinal) projects have no events to map
+        if not int(self.project_info.get("is_longitudinal", 1)):
+            return []
+        return self.rs.get_instrument_event_mappings()
+
+    @cached_property
+    def fingerprint(self):
+        return hashlib.sha256(
+            json.dumps(
+                [self.data_dictionary, self.instrument_event_mappings],
+                sort_keys=True,
+            ).encode()
+        ).hexdigest()
+
+    def to_dict(self):
+        """The fetched metadata, for ProjectMetadata(rs, **saved) later"""
+        return {
+            "project_info": self.project_info,
+            "data_dictionary": self.data_dictionary,
+            "instrument_event_mappings": self.instrument_event_mappings,
+        }
+
+    @cached_property
+    def _cache_path(self):
+        if not self.cache_dir:
+            return None
+        return os.path.join(
+            self.cache_dir,
+            f"redcap_{self.project_info['project_id']}",
+            "metadata.json",
+        )
+
+    @cached_property
+    def derived(self):
+        if self.fingerprint in _derived:
+            return _derived[self.fingerprint]
+        path = self._cache_path
+        if path:
+            try:
+                with open(path) as f:
+                    cached = json.load(f)
+                if cached["fingerprint"] == self.fingerprint:
+                    _derived[self.fingerprint] = cached["derived"]
+                    return cached["derived"]
+            except (OSError, ValueError, KeyError):
+                pass
+
+        logging.info("REDCap metadata changed; rebuilding derived lookups")
+        derived = derive(self.data_dictionary, self.instrument_event_mappings)
+        if path:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f"{path}.{os.getpid()}.tmp"
+            with open(tmp, "w") as f:
+                json.dump(
+                    {"fingerprint": self.fingerprint, "derived": derived}, f
+                )
+            os.replace(tmp, path)
+        _derived[self.fingerprint] = derived
+        return derived
+
+    @property
+    def record_id_field(self):
+        return self.derived["record_id_field"]
+
+    @property
+    def identifier_fields(self):
+        return self.derived["identifier_fields"]
+
+    @property
+    def date_fields(self):
+        return self.derived["date_fields"]
+
+    @property
+    def note_fields(self):
+        return self.derived["note_fields"]
+
+    @property
+    def field_forms(self):
+        """{field: form}"""
+        return self.derived["field_forms"]
+
+    @property
+    def form_events(self):
+        """{form: first event it is in}"""
+        return self.derived["form_events"]
+
+    @property
+    def choice_map(self):
+        """{selector field: {raw value: label}}"""
+        return self.derived["choice_map"]
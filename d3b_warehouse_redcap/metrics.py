@@ -0,0 +1,200 @@
+import cProfile
+import json
+import os
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+from d3b_warehouse_redcap.io import (
+    add_request_observer,
+    remove_request_observer,
+)
+
+
+def peak_rss_mb():
+    """Returns the process's peak resident memory so far in MB"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux but bytes on macOS
+    if sys.platform == "darwin":
+        peak //= 1024
+    return round(peak / 1024, 1)
+
+
+def _proc_status_mb(field):
+    """Returns a memory field (e.g. VmRSS) of /proc/self/status in MB, or
+    None where there is no /proc"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    return None
+
+
+def rss_mb():
+    """Returns the process's current resident memory in MB, or None if it
+    can't be read"""
+    return _proc_status_mb("VmRSS")
+
+
+def reset_peak_rss():
+    """
+    Start measuring peak resident memory afresh (Linux only), so that
+    peak_rss_mb covers only what comes after. Returns whether it could.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def shape(data):
+    """
+    Returns {"rows", "columns"} for a DataFrame, or the totals (plus a
+    "tables" count) for a dict of DataFrames. Returns None for anything else.
+    """
+    if isinstance(data, dict):
+        shapes = [shape(df) for df in data.values()]
+        shapes = [s for s in shapes if s]
+        return {
+            "tables": len(shapes),
+            "rows": sum(s["rows"] for s in shapes),
+            "columns": sum(s["columns"] for s in shapes),
+        }
+    if hasattr(data, "shape") and len(data.shape) == 2:
+        return {"rows": int(data.shape[0]), "columns": int(data.shape[1])}
+    return None
+
+
+class Stage:
+    """What one run of a pipeline stage did"""
+
+    def __init__(self, name, data_in=None, **attrs):
+        self.record = {"stage": name, **attrs, "in": shape(data_in)}
+        self.peak_rss_mb = 0.0
+
+    def output(self, data_out):
+        """Record the shape of what the stage produced"""
+        self.record["out"] = shape(data_out)
+
+
+class Metrics:
+    """
+    Collects wall time, memory and data shapes for each pipeline stage of
+    a run, plus counts and timings of HTTP requests made via send_request.
+    Stages named in profile_stages are also run under cProfile, with stats
+    written to profile_dir.
+
+    A stage's peak_rss_mb is the most resident memory used while it ran,
+    and rss_mb what was still resident when it finished. On Linux the peak
+    is reset at the start of each stage. Elsewhere it can't be, so
+    peak_rss_mb is the process's peak so far and stage_peaks is false in
+    to_dict.
+    """
+
+    def __init__(self, profile_stages=(), profile_dir="."):
+        self.started = time.time()
+        self.stages = []
+        self.http = {"requests": 0, "seconds": 0.0, "by_status": {}}
+        self.profile_stages = set(profile_stages)
+        self.profile_dir = profile_dir
+        self._lock = threading.Lock()
+        # stages in progress, whose peaks a reset must not lose
+        self._open = []
+        self.peak_rss_mb = 0.0
+        self.stage_peaks = None
+
+    def _fold_peak(self):
+        """Add the peak since the last reset to every stage in progress"""
+        peak = _proc_status_mb("VmHWM") or peak_rss_mb()
+        self.peak_rss_mb = max(self.peak_rss_mb, peak)
+        for st in self._open:
+            st.peak_rss_mb = max(st.peak_rss_mb, peak)
+
+    @contextmanager
+    def stage(self, name, data_in=None, **attrs):
+        """
+        Time a stage of the pipeline. attrs are added to the stage's record.
+
+            with metrics.stage("safe_dates", dfs) as st:
+                ...
+                st.output(dfs)
+        """
+        st = Stage(name, data_in, **attrs)
+        with self._lock:
+            self._fold_peak()
+            self._open.append(st)
+            self.stage_peaks = reset_peak_rss()
+        profiler = None
+        if name in self.profile_stages:
+            profiler = cProfile.Profile()
+            profiler.enable()
+        start = time.perf_counter()
+        try:
+            yield st
+        finally:
+            seconds = time.perf_counter() - start
+            if profiler:
+                profiler.disable()
+                os.makedirs(self.profile_dir, exist_ok=True)
+                label = "_".join(str(v) for v in [name, *attrs.values()])
+                path = os.path.join(self.profile_dir, f"{label}.prof")
+                profiler.dump_stats(path)
+                st.record["profile"] = path
+            st.record["seconds"] = round(seconds, 3)
+            with self._lock:
+                self._fold_peak()
+                self._open.remove(st)
+                st.record["peak_rss_mb"] = st.peak_rss_mb
+                st.record["rss_mb"] = rss_mb()
+                self.stages.append(st.record)
+            print(
+                f"Stage {name}"
+                + "".join(f" {v}" for v in attrs.values())
+                + f": {seconds:.1f} s,"
+                f" peak memory {st.record['peak_rss_mb']:.0f} MB"
+            )
+
+    def observe_request(self, method, url, status_code, seconds):
+        with self._lock:
+            self.http["requests"] += 1
+            self.http["seconds"] = round(self.http["seconds"] + seconds, 3)
+            key = str(status_code)
+            by_status = self.http["by_status"]
+            by_status[key] = by_status.get(key, 0) + 1
+
+    @contextmanager
+    def observing_requests(self):
+        """Count and time send_request calls while in this context"""
+        add_request_observer(self.observe_request)
+        try:
+            yield self
+        finally:
+            remove_request_observer(self.observe_request)
+
+    def to_dict(self, **extra):
+        with self._lock:
+            self._fold_peak()
+        return {
+            "started": self.started,
+            "seconds": round(time.time() - self.started, 3),
+            "peak_rss_mb": self.peak_rss_mb,
+            "stage_peaks": bool(self.stage_peaks),
+            **extra,
+            "stages": self.stages,
+            "http": self.http,
+        }
+
+    def write(self, path, **extra):
+        """Write the metrics as JSON to path, or as one line to stdout for -"""
+        if path == "-":
+            print(json.dumps(self.to_dict(**extra), default=str))
+            return
+        with open(path, "w") as f:
+            json.dump(self.to_dict(**extra), f, indent=2, default=str)
@@ -0,0 +1,838 @@
+import hashlib
+import json
+import logging
+import math
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime
+from decimal import Decimal
+from io import StringIO
+
+from pandas import DataFrame, read_sql_table
+from pandas.api.types import (
+    is_datetime64_any_dtype,
+    is_float_dtype,
+    is_integer_dtype,
+)
+from pandas.util import hash_pandas_object
+from sqlalchemy import Enum, MetaData, Table, and_, inspect, or_, text
+
+# Columns (besides CID) that tell apart the rows of one subject in an
+# instrument table
+EVENT_COLUMNS = ("redcap_event_name", "event")
+INSTANCE_SUFFIX = "_instance"
+
+NULL_TOKEN = "\x00"
+DELETE_BATCH_SIZE = 500
+
+# How rows get written: multi-row INSERT statements, or COPY FROM STDIN on
+# PostgreSQL (other databases fall back to insert)
+LOADERS = ("insert", "copy")
+INSERT_CHUNKSIZE = 10000
+COPY_CHUNKSIZE = 100000
+POSTGRES_MAX_IDENTIFIER = 63
+
+STAGING_SCHEMA_SUFFIX = "__staging"
+PREVIOUS_SCHEMA_SUFFIX = "__previous"
+
+# Per-schema record of the content hash of each table as last loaded
+TABLE_HASHES = "warehouse_table_hashes"
+
+INDEX_PREFIX = "ix_"
+
+# A single-quoted SQL string literal, as in a CHECK constraint's text
+QUOTED_LITERAL = re.compile(r"'((?:[^']|'')*)'")
+
+
+def key_columns(df):
+    """Returns the (CID, event, repeat instance) columns that key df's rows"""
+    if "CID" not in df:
+        return []
+    return (
+        ["CID"]
+        + [c for c in EVENT_COLUMNS if c in df]
+        + [c for c in df.columns if c.endswith(INSTANCE_SUFFIX)]
+    )
+
+
+def index_columns(columns):
+    """
+    Returns the column lists to index in a table with the given columns: its
+    (CID, event, repeat instance) key together, and the subject, event and
+    repeat instance columns on their own
+    """
+    columns = list(columns)
+    instances = [c for c in columns if c.endswith(INSTANCE_SUFFIX)]
+    singles = [c for c in ["subject", *EVENT_COLUMNS] if c in columns]
+    indexes = [[c] for c in singles + instances]
+    if "CID" in columns:
+        keys = ["CID"] + [c for c in EVENT_COLUMNS if c in columns] + instances
+        indexes.insert(0, keys)
+    return indexes
+
+
+def _table_indexes(name, columns, extra_indexes=None):
+    """index_columns plus the extra indexes asked for on table name"""
+    indexes = index_columns(columns)
+    for extra in (extra_indexes or {}).get(name, []):
+        missing = set(extra) - set(columns)
+        if missing:
+            logging.warning(
+                "Not indexing %s on %s: no column %s",
+                name,
+                ", ".join(extra),
+                ", ".join(sorted(missing)),
+            )
+        elif list(extra) not in indexes:
+            indexes.append(list(extra))
+    return indexes
+
+
+def _index_name(name, columns):
+    index = f"{INDEX_PREFIX}{name}__{'__'.join(columns)}"
+    if len(index) > POSTGRES_MAX_IDENTIFIER:
+        digest = hashlib.sha1(index.encode()).hexdigest()[:8]
+        index = f"{index[:POSTGRES_MAX_IDENTIFIER - 9]}_{digest}"
+    return index
+
+
+def create_indexes(conn, name, schema_name, indexes, analyze=True):
+    """
+    Create whichever of the indexes (lists of columns) table name doesn't
+    have yet, then ANALYZE it so the query planner has statistics for its
+    new rows. schema_name may be None for the default schema.
+    """
+    quote = conn.dialect.identifier_preparer.quote
+    table = quote(name)
+    if schema_name:
+        table = f"{quote(schema_name)}.{table}"
+    for columns in indexes:
+        index = quote(_index_name(name, columns))
+        if conn.dialect.name == "sqlite":
+            # SQLite qualifies the index, not the table, with the schema
+            if schema_name:
+                index = f"{quote(schema_name)}.{index}"
+            on = f"{index} ON {quote(name)}"
+        else:
+            on = f"{index} ON {table}"
+        conn.execute(
+            text(
+                f"CREATE INDEX IF NOT EXISTS {on}"
+                f" ({', '.join(quote(c) for c in columns)})"
+            )
+        )
+    if analyze and conn.dialect.name in ("postgresql", "sqlite"):
+        conn.execute(text(f"ANALYZE {table}"))
+
+
+def index_tables(
+    db_engine, schema_name, tables, extra_indexes=None, analyze=True
+):
+    """
+    Add any missing indexes to already loaded tables, given as {table:
+    columns}, in one transaction
+    """
+    with db_engine.begin() as conn:
+        for name, columns in tables.items():
+            create_indexes(
+                conn,
+                name,
+                schema_name,
+                _table_indexes(name, columns, extra_indexes),
+                analyze,
+            )
+
+
+def _normalize_value(v):
+    if v is None:
+        return NULL_TOKEN
+    if isinstance(v, float) and v.is_integer():
+        return str(int(v))
+    return str(v)
+
+
+def _normalized(df):
+    """
+    Returns df with every value as a string, so that rows built in memory
+    compare equal to the same rows read back from the database (e.g. Int64 1
+    vs float 1.0, pd.NA vs None).
+    """
+    return DataFrame(
+        {
+            c: df[c]
+            .astype(object)
+            .where(df[c].notna(), None)
+            .map(_normalize_value)
+            for c in df.columns
+        },
+        index=df.index,
+    )
+
+
+def _row_hashes(df, keys):
+    """
+    Returns {normalized key: row content hash} in row order. Keys must be
+    unique.
+    """
+    norm = _normalized(df)
+    hashes = hash_pandas_object(norm[sorted(norm.columns)], index=False)
+    return dict(
+        zip(norm[keys].itertuples(index=False, name=None), hashes.values)
+    )
+
+
+def _csv_value(v):
+    """
+    Returns v as a field of PostgreSQL CSV. NULL is an unquoted empty field
+    and strings are always quoted, so an empty string ("") stays apart from
+    NULL. (The csv module can't do this: QUOTE_NONNUMERIC quotes None too.)
+    """
+    if v is None or (isinstance(v, float) and math.isnan(v)):
+        return ""
+    if isinstance(v, str):
+        return '"' + v.replace('"', '""') + '"'
+    return str(v)
+
+
+def copy_insert(table, conn, keys, data_iter):
+    """
+    pandas to_sql method that streams each chunk of rows into the table as
+    CSV through PostgreSQL COPY FROM STDIN.
+    """
+    buf = StringIO()
+    buf.writelines(
+        ",".join(_csv_value(v) for v in row) + "\n" for row in data_iter
+    )
+    buf.seek(0)
+
+    quote = conn.dialect.identifier_preparer.quote
+    table_name = quote(table.name)
+    if table.schema:
+        table_name = f"{quote(table.schema)}.{table_name}"
+    columns = ", ".join(quote(k) for k in keys)
+
+    with conn.connection.cursor() as cur:
+        cur.copy_expert(
+            f"COPY {table_name} ({columns}) FROM STDIN WITH (FORMAT csv)", buf
+        )
+
+
+def _write_method(db_engine, loader):
+    """Returns the (method, chunksize) for to_sql with the given loader"""
+    if loader == "copy":
+        if db_engine.dialect.name == "postgresql":
+            return copy_insert, COPY_CHUNKSIZE
+        logging.info(
+            "COPY loading needs PostgreSQL, not %s; using INSERTs",
+            db_engine.dialect.name,
+        )
+    return "multi", INSERT_CHUNKSIZE
+
+
+def _staging_name(name):
+    return f"{name[:POSTGRES_MAX_IDENTIFIER - len('__staging')]}__staging"
+
+
+def replace_table(
+    db_engine, df, name, schema_name, loader="insert", dtype=None
+):
+    """
+    Rewrite a whole table in one transaction. With the copy loader the rows
+    go into a staging table first, which then replaces the live one, so the
+    live table is only locked at the end. dtype is passed on to to_sql for
+    column SQL types.
+    """
+    method, chunksize = _write_method(db_engine, loader)
+    with db_engine.begin() as conn:
+        return _replace(conn, df, name, schema_name, method, chunksize, dtype)
+
+
+def _replace(conn, df, name, schema_name, method, chunksize, dtype):
+    if method == "multi":
+        df.to_sql(
+            name,
+            conn,
+            index=False,
+            if_exists="replace",
+            schema=schema_name,
+            method=method,
+            chunksize=chunksize,
+            dtype=dtype,
+        )
+        return {"mode": "replace", "rows": len(df)}
+
+    staging = _staging_name(name)
+    quote = conn.dialect.identifier_preparer.quote
+    df.head(0).to_sql(
+        staging,
+        conn,
+        index=False,
+        if_exists="replace",
+        schema=schema_name,
+        dtype=dtype,
+    )
+    df.to_sql(
+        staging,
+        conn,
+        index=False,
+        if_exists="append",
+        schema=schema_name,
+        method=method,
+        chunksize=chunksize,
+    )
+    conn.execute(
+        text(f"DROP TABLE IF EXISTS {quote(schema_name)}.{quote(name)}")
+    )
+    conn.execute(
+        text(
+            f"ALTER TABLE {quote(schema_name)}.{quote(staging)}"
+            f" RENAME TO {quote(name)}"
+        )
+    )
+    return {"mode": "replace", "rows": len(df)}
+
+
+def _column_kind(t):
+    """Returns "number", "date" or "text" for a pandas dtype or SQL type"""
+    if hasattr(t, "python_type"):
+        try:
+            python_type = t.python_type
+        except NotImplementedError:
+            return None
+        if python_type in (int, float, Decimal):
+            return "number"
+        if python_type in (date, datetime):
+            return "date"
+        return "text" if python_type is str else None
+    if is_integer_dtype(t) or is_float_dtype(t):
+        return "number"
+    if is_datetime64_any_dtype(t):
+        return "date"
+    return "text"
+
+
+def _retyped(conn, df, name, schema_name):
+    """Whether any of df's columns changed kind from the table's column"""
+    table_kinds = {
+        c["name"]: _column_kind(c["type"])
+        for c in inspect(conn).get_columns(name, schema=schema_name)
+    }
+    return any(
+        table_kinds.get(c) not in (None, _column_kind(df[c].dtype))
+        for c in df.columns
+    )
+
+
+def _choices_changed(conn, name, schema_name, dtype):
+    """
+    Whether any choice column in dtype (a length-limited string CHECKed
+    against its labels, see sql_column_types) has a different length or set
+    of labels in the table
+    """
+    enums = {c: t for c, t in (dtype or {}).items() if isinstance(t, Enum)}
+    if not enums:
+        return False
+    inspector = inspect(conn)
+    lengths = {
+        c["name"]: getattr(c["type"], "length", None)
+        for c in inspector.get_columns(name, schema=schema_name)
+    }
+    try:
+        checks = [
+            c["sqltext"]
+            for c in inspector.get_check_constraints(name, schema=schema_name)
+        ]
+    except NotImplementedError:
+        return True
+    for column, t in enums.items():
+        if lengths.get(column) != t.length:
+            return True
+        column_labels = [
+            {v.replace("''", "'") for v in QUOTED_LITERAL.findall(sql)}
+            for sql in checks
+            if re.search(rf"\b{re.escape(column)}\b", sql)
+        ]
+        if set(t.enums) not in column_labels:
+            return True
+    return False
+
+
+def diff_table(db_engine, df, name, schema_name, loader="insert", dtype=None):
+    """
+    Apply only the inserts, updates and deletes needed to make a warehouse
+    table match df, in one transaction. Rows are matched on key_columns(df).
+
+    Falls back to replacing the table if it doesn't exist yet, its columns,
+    their types or the labels allowed in its choice columns (see dtype) have
+    changed, or df's rows can't be keyed uniquely.
+
+        Returns:
+            counts (dict): mode and per-kind changed row counts
+    """
+    method, chunksize = _write_method(db_engine, loader)
+    with db_engine.begin() as conn:
+        return _diff(conn, df, name, schema_name, method, chunksize, dtype)
+
+
+def _diff(conn, df, name, schema_name, method, chunksize, dtype):
+    keys = key_columns(df)
+    if (
+        keys
+        and not df.duplicated(subset=keys).any()
+        and inspect(conn).has_table(name, schema=schema_name)
+    ):
+        old = read_sql_table(name, conn, schema=schema_name)
+        if (
+            set(old.columns) == set(df.columns)
+            and not old.duplicated(subset=keys).any()
+            and not _retyped(conn, df, name, schema_name)
+            and not _choices_changed(conn, name, schema_name, dtype)
+        ):
+            return _apply_diff(
+                conn, df, old, name, schema_name, keys, method, chunksize
+            )
+        logging.info("Columns of %s.%s changed; replacing", schema_name, name)
+    return _replace(conn, df, name, schema_name, method, chunksize, dtype)
+
+
+def _apply_diff(conn, df, old, name, schema_name, keys, method, chunksize):
+    new_h = _row_hashes(df, keys)
+    old_h = _row_hashes(old, keys)
+
+    new_keys = set(new_h)
+    old_keys = set(old_h)
+    common = new_keys & old_keys
+    inserted = new_keys - old_keys
+    deleted = old_keys - new_keys
+    updated = {k for k in common if new_h[k] != old_h[k]}
+
+    # updated rows are deleted and then reinserted
+    stale = deleted | updated
+    if stale:
+        old_raw = old[[k in stale for k in old_h]][keys]
+        table = Table(name, MetaData(), autoload_with=conn, schema=schema_name)
+        conditions = [
+            and_(
+                *[
+                    table.c[c] == v if v is not None else table.c[c].is_(None)
+                    for c, v in zip(keys, row)
+                ]
+            )
+            for row in old_raw.astype(object)
+            .where(old_raw.notna(), None)
+            .itertuples(index=False)
+        ]
+        for i in range(0, len(conditions), DELETE_BATCH_SIZE):
+            conn.execute(
+                table.delete().where(
+                    or_(*conditions[i : i + DELETE_BATCH_SIZE])
+                )
+            )
+
+    fresh = inserted | updated
+    if fresh:
+        df[[k in fresh for k in new_h]].to_sql(
+            name,
+            conn,
+            index=False,
+            if_exists="append",
+            schema=schema_name,
+            method=method,
+            chunksize=chunksize,
+        )
+
+    return {
+        "mode": "diff",
+        "inserted": len(inserted),
+        "updated": len(updated),
+        "deleted": len(deleted),
+    }
+
+
+def load_tables(
+    db_engine,
+    dfs,
+    schema_name,
+    load_mode="replace",
+    loader="insert",
+    max_workers=4,
+    dtypes=None,
+    extra_indexes=None,
+):
+    """
+    Replace or diff-load many tables so that either all of them change or
+    none do. Each table is indexed on its index_columns and any
+    extra_indexes ({table: [[column, ...], ...]}) and analyzed as it loads.
+
+    Replacing on PostgreSQL, the tables are loaded concurrently over up to
+    max_workers connections, each into a staging table next to the live
+    one. One short transaction then swaps every staging table in. Readers
+    only wait on that last transaction, but it locks all of the tables at
+    once. If any table fails, the staging tables are dropped and the live
+    ones are left as they were.
+
+    Diffs are applied to the live tables in place, so only changed rows are
+    written, over one connection in one transaction. So are loads into
+    other databases and single tables. That transaction holds its locks
+    until every table has loaded.
+
+        Returns:
+            counts (dict): per-table results, with the seconds each took
+    """
+    load = {"replace": _replace, "diff": _diff}[load_mode]
+    method, chunksize = _write_method(db_engine, loader)
+    dtypes = dtypes or {}
+    indexes = {
+        name: _table_indexes(name, df.columns, extra_indexes)
+        for name, df in dfs.items()
+    }
+
+    def load_table(conn, name, target):
+        """Load dfs[name] into table target and index it"""
+        start = time.perf_counter()
+        try:
+            result = load(
+                conn,
+                dfs[name],
+                target,
+                schema_name,
+                method,
+                chunksize,
+                dtypes.get(name),
+            )
+            result["seconds"] = round(time.perf_counter() - start, 3)
+            start = time.perf_counter()
+            create_indexes(conn, target, schema_name, indexes[name])
+        except Exception:
+            logging.error("Loading %s.%s failed", schema_name, name)
+            raise
+        result["index_seconds"] = round(time.perf_counter() - start, 3)
+        return result
+
+    if (
+        load_mode == "diff"
+        or db_engine.dialect.name != "postgresql"
+        or len(dfs) < 2
+    ):
+        with db_engine.begin() as conn:
+            return {name: load_table(conn, name, name) for name in dfs}
+
+    quote = db_engine.dialect.identifier_preparer.quote
+
+    def qualified(name):
+        return f"{quote(schema_name)}.{quote(name)}"
+
+    staged = {name: _staging_name(name) for name in dfs}
+    failed = threading.Event()
+
+    def stage_table(name):
+        if failed.is_set():
+            return None
+        staging = qualified(staged[name])
+        try:
+            with db_engine.begin() as conn:
+                conn.execute(text(f"DROP TABLE IF EXISTS {staging}"))
+                return load_table(conn, name, staged[name])
+        except Exception:
+            failed.set()
+            raise
+
+    try:
+        # biggest first, to even out how long each connection takes
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            futures = {
+                name: pool.submit(stage_table, name)
+                for name in sorted(
+                    dfs, key=lambda n: dfs[n].size, reverse=True
+                )
+            }
+        counts = {name: f.result() for name, f in futures.items()}
+
+        statements = []
+        for name, staging in staged.items():
+            statements += [
+                f"DROP TABLE IF EXISTS {qualified(name)}",
+                f"ALTER TABLE {qualified(staging)} RENAME TO {quote(name)}",
+            ]
+            statements += [
+                f"ALTER INDEX {qualified(_index_name(staging, columns))}"
+                f" RENAME TO {quote(_index_name(name, columns))}"
+                for columns in indexes[name]
+            ]
+        _execute_all(db_engine, statements)
+    except Exception:
+        logging.error("Left every table in %s as it was", schema_name)
+        try:
+            _execute_all(
+                db_engine,
+                [
+                    f"DROP TABLE IF EXISTS {qualified(staging)}"
+                    for staging in staged.values()
+                ],
+            )
+        except Exception as e:
+            logging.warning("Couldn't drop staging tables: %s", e)
+        raise
+    return counts
+
+
+def table_hash(df):
+    """
+    Returns a hash of df's column names, dtypes and values that is stable
+    across runs and processes
+    """
+    h = hashlib.sha256()
+    h.update(
+        json.dumps([[str(c), str(t)] for c, t in df.dtypes.items()]).encode()
+    )
+    h.update(hash_pandas_object(df, index=False).values.tobytes())
+    return h.hexdigest()
+
+
+def read_table_hashes(db_engine, schema_name):
+    """Returns {table: content hash} as of each table's last load"""
+    if not inspect(db_engine).has_table(TABLE_HASHES, schema=schema_name):
+        return {}
+    quote = db_engine.dialect.identifier_preparer.quote
+    with db_engine.connect() as conn:
+        return dict(
+            conn.execute(
+                text(
+                    "SELECT table_name, content_hash"
+                    f" FROM {quote(schema_name)}.{quote(TABLE_HASHES)}"
+                )
+            ).fetchall()
+        )
+
+
+def record_table_hashes(db_engine, schema_name, hashes, row_counts=None):
+    """Save the content hashes of freshly loaded tables"""
+    quote = db_engine.dialect.identifier_preparer.quote
+    table = f"{quote(schema_name)}.{quote(TABLE_HASHES)}"
+    row_counts = row_counts or {}
+    with db_engine.begin() as conn:
+        conn.execute(
+            text(
+                f"CREATE TABLE IF NOT EXISTS {table} (table_name TEXT,"
+                " content_hash TEXT, row_count BIGINT, loaded_at TIMESTAMP)"
+            )
+        )
+        for name, content_hash in hashes.items():
+            conn.execute(
+                text(f"DELETE FROM {table} WHERE table_name = :name"),
+                {"name": name},
+            )
+            conn.execute(
+                text(
+                    f"INSERT INTO {table} VALUES"
+                    " (:name, :content_hash, :row_count, :loaded_at)"
+                ),
+                {
+                    "name": name,
+                    "content_hash": content_hash,
+                    "row_count": row_counts.get(name),
+                    "loaded_at": datetime.utcnow(),
+                },
+            )
+
+
+def _execute_all(db_engine, statements):
+    """Run SQL statements in one transaction"""
+    with db_engine.begin() as conn:
+        for statement in statements:
+            conn.execute(text(statement))
+
+
+def swap_load(
+    db_engine,
+    dfs,
+    schema_name,
+    loader="insert",
+    max_workers=4,
+    dtypes=None,
+    keep=(),
+    on_staged=None,
+    extra_indexes=None,
+):
+    """
+    Load every table into a fresh staging schema, concurrently and without
+    touching the live schema, then swap it into place in one short
+    transaction. The schema it replaces is kept as <schema>__previous for
+    restore_previous_schema. Tables named in keep are copied over from the
+    live schema as they are. Every staged table is indexed and analyzed as
+    by load_tables. on_staged(staging schema name) is called once everything
+    is staged, just before the swap.
+
+    Schema and table grants belong to the schema objects, so they don't
+    carry over to the new schema. Give readers access with ALTER DEFAULT
+    PRIVILEGES (for SCHEMAS and TABLES) for the loading role instead. Views
+    on the live tables follow them into <schema>__previous, so they have to
+    be recreated after the swap.
+
+    PostgreSQL only. dtypes optionally gives each table's to_sql dtype.
+
+        Returns:
+            counts (dict): per-table results from replace_table
+    """
+    staging = create_staging_schema(db_engine, schema_name)
+    method, chunksize = _write_method(db_engine, loader)
+
+    def stage_table(name, df):
+        with db_engine.begin() as conn:
+            result = _replace(
+                conn,
+                df,
+                name,
+                staging,
+                method,
+                chunksize,
+                (dtypes or {}).get(name),
+            )
+            create_indexes(
+                conn,
+                name,
+                staging,
+                _table_indexes(name, df.columns, extra_indexes),
+            )
+        return result
+
+    # any failure raises here, before the live schema is touched
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = {
+            name: pool.submit(stage_table, name, df)
+            for name, df in dfs.items()
+        }
+        counts = {name: f.result() for name, f in futures.items()}
+
+    quote = db_engine.dialect.identifier_preparer.quote
+    statements = []
+    for name in keep:
+        live = f"{quote(schema_name)}.{quote(name)}"
+        copy = f"{quote(staging)}.{quote(name)}"
+        statements += [
+            # indexes are left to create_indexes, so they get the same
+            # names (and aren't duplicated) on every swap
+            f"CREATE TABLE {copy}"
+            f" (LIKE {live} INCLUDING ALL EXCLUDING INDEXES)",
+            f"INSERT INTO {copy} SELECT * FROM {live}",
+        ]
+    _execute_all(db_engine, statements)
+    # index the copies once their rows are in, and analyze them
+    inspector = inspect(db_engine)
+    kept_columns = {
+        name: [c["name"] for c in inspector.get_columns(name, staging)]
+        for name in keep
+    }
+    index_tables(db_engine, staging, kept_columns, extra_indexes)
+    counts.update({name: {"mode": "kept"} for name in keep})
+    if on_staged is not None:
+        on_staged(staging)
+
+    swap_in_staging_schema(db_engine, schema_name)
+    return counts
+
+
+def create_staging_schema(db_engine, schema_name):
+    """(Re)create an empty staging schema for schema_name and return its name"""
+    quote = db_engine.dialect.identifier_preparer.quote
+    staging = schema_name + STAGING_SCHEMA_SUFFIX
+    _execute_all(
+        db_engine,
+        [
+            f"DROP SCHEMA IF EXISTS {quote(staging)} CASCADE",
+            f"CREATE SCHEMA {quote(staging)}",
+        ],
+    )
+    return staging
+
+
+def swap_in_staging_schema(db_engine, schema_name):
+    """
+    Make the staging schema live in one transaction, keeping the schema it
+    replaces as <schema>__previous.
+    """
+    quote = db_engine.dialect.identifier_preparer.quote
+    staging = schema_name + STAGING_SCHEMA_SUFFIX
+    previous = schema_name + PREVIOUS_SCHEMA_SUFFIX
+    statements = [f"DROP SCHEMA IF EXISTS {quote(previous)} CASCADE"]
+    if db_engine.dialect.has_schema(db_engine, schema_name):
+        statements.append(
+            f"ALTER SCHEMA {quote(schema_name)} RENAME TO {quote(previous)}"
+        )
+    statements.append(
+        f"ALTER SCHEMA {quote(staging)} RENAME TO {quote(schema_name)}"
+    )
+    _execute_all(db_engine, statements)
+
+
+def restore_previous_schema(db_engine, schema_name):
+    """
+    Swap the live schema with the one kept by the last swap_load, so the
+    previous load is live again (and running it twice undoes it).
+    """
+    quote = db_engine.dialect.identifier_preparer.quote
+    previous = schema_name + PREVIOUS_SCHEMA_SUFFIX
+    if not db_engine.dialect.has_schema(db_engine, previous):
+        raise ValueError(f"No previous load of {schema_name} to restore")
+    swapping = schema_name + "__swapping"
+    _execute_all(
+        db_engine,
+        [
+            f"ALTER SCHEMA {quote(schema_name)} RENAME TO {quote(swapping)}",
+            f"ALTER SCHEMA {quote(previous)} RENAME TO {quote(schema_name)}",
+            f"ALTER SCHEMA {quote(swapping)} RENAME TO {quote(previous)}",
+        ],
+    )
+
+
+class MaskIndex:
+    """
+    The private values already registered in each mask identifier table.
+    Each table is read from the warehouse once and then kept up to date in
+    memory, so only genuinely new identifiers need to be submitted.
+    """
+
+    def __init__(self, db_engine):
+        self.db_engine = db_engine
+        self.known = {}
+
+    def _load(self, table):
+        if table not in self.known:
+            known = set()
+            if inspect(self.db_engine).has_table(table):
+                quote = self.db_engine.dialect.identifier_preparer.quote
+                with self.db_engine.connect() as conn:
+                    known = {
+                        str(v)
+                        for (v,) in conn.execute(
+                            text(f"SELECT private FROM {quote(table)}")
+                        )
+                    }
+            self.known[table] = known
+        return self.known[table]
+
+    def split(self, table, values):
+        """Returns (new, known) lists of the given values"""
+        known = self._load(table)
+        new, old = [], []
+        for v in values:
+            (old if str(v) in known else new).append(v)
+        return new, old
+
+    def add(self, table, values):
+        self._load(table).update(str(v) for v in values)
+
+
+def index_mask_table(db_engine, table):
+    """
+    Index a mask table on its private column (unless that is already its
+    primary key) and ANALYZE it
+    """
+    primary_key = inspect(db_engine).get_pk_constraint(table)
+    indexes = [["private"]]
+    if primary_key["constrained_columns"] == ["private"]:
+        indexes = []
+    with db_engine.begin() as conn:
+        create_indexes(conn, table, None, indexes)
@@ -0,0 +1,47 @@
+from types import SimpleNamespace
+
+import pytest
+from pandas import DataFrame
+
+pytest.importorskip("d3b_redcap_api")
+
+from warehouse_project import do_backfill  # noqa: E402
+
+
+class FakeStudy:
+    def __init__(self):
+        self.sent = []
+
+    def set_records(self, records):
+        self.sent.extend(records)
+        return {"count": len(records)}
+
+
+def backfill(mappings, form_events):
+    metadata = SimpleNamespace(
+        field_forms={"study_id": "enrollment"},
+        form_events=form_events,
+        instrument_event_mappings=mappings,
+    )
+    redcap_dfs = {
+        "enrollment": DataFrame(
+            {"subject": ["1", "2"], "study_id": ["01ABC", None]}
+        )
+    }
+    study = FakeStudy()
+    do_backfill(study, metadata, redcap_dfs, ["study_id"])
+    assert redcap_dfs["enrollment"]["study_id"].notna().all()
+    return study.sent
+
+
+def test_backfill_classic_project():
+    [record] = backfill([], {})
+    assert record["record"] == "2"
+    assert "redcap_event_name" not in record
+
+
+def test_backfill_longitudinal_project():
+    mappings = [{"form": "enrollment", "unique_event_name": "baseline_arm_1"}]
+    [record] = backfill(mappings, {"enrollment": "baseline_arm_1"})
+    assert record["record"] == "2"
+    assert record["redcap_event_name"] == "baseline_arm_1"
@@ -0,0 +1,20 @@
+import time
+
+from pandas import DataFrame
+
+from d3b_warehouse_redcap.checkpoint import CheckpointStore
+
+
+def test_resume_skips_stale_checkpoints(tmp_path):
+    store = CheckpointStore(str(tmp_path))
+    dfs = {"demographics": DataFrame({"subject": ["1", "2"]})}
+    checkpoint = store.create(1, dfs)
+    checkpoint.save("extract", dfs)
+
+    assert store.latest_incomplete(1).path == checkpoint.path
+    assert store.latest_incomplete(1, max_age=3600).path == checkpoint.path
+
+    checkpoint.manifest["created"] = time.time() - 2 * 3600
+    checkpoint._save_manifest()
+    assert store.latest_incomplete(1, max_age=3600) is None
+    assert store.latest_incomplete(1).path == checkpoint.path
@@ -0,0 +1,92 @@
+import os
+from datetime import date, datetime
+
+import pytest
+from pandas import DataFrame, NaT, Series, read_sql_table
+
+from d3b_warehouse_redcap.warehouse import copy_insert
+
+
+class _Cursor:
+    def __init__(self):
+        self.copied = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def copy_expert(self, sql, buf):
+        self.sql = sql
+        self.copied = buf.read()
+
+
+class _Conn:
+    """Just enough of a SQLAlchemy connection for copy_insert"""
+
+    class dialect:
+        class identifier_preparer:
+            quote = staticmethod(lambda name: f'"{name}"')
+
+    def __init__(self):
+        self.cursor_ = _Cursor()
+        self.connection = self
+
+    def cursor(self):
+        return self.cursor_
+
+
+class _Table:
+    name = "t"
+    schema = "s"
+
+
+def test_nulls_are_unquoted_and_empty_strings_quoted():
+    conn = _Conn()
+    rows = [
+        ["", 1, 1.5, datetime(2020, 2, 29)],
+        [None, None, None, None],
+        ['say "hi", twice', 2, float("nan"), date(2021, 1, 1)],
+    ]
+    copy_insert(_Table, conn, ["text", "int", "float", "when"], iter(rows))
+    assert conn.cursor_.sql == (
+        'COPY "s"."t" ("text", "int", "float", "when")'
+        " FROM STDIN WITH (FORMAT csv)"
+    )
+    assert conn.cursor_.copied.splitlines() == [
+        '"",1,1.5,2020-02-29 00:00:00',
+        ",,,",
+        '"say ""hi"", twice",2,,2021-01-01',
+    ]
+
+
+@pytest.mark.skipif(
+    not os.environ.get("WAREHOUSE_TEST_DB_URL"),
+    reason="set WAREHOUSE_TEST_DB_URL to a PostgreSQL database to run",
+)
+def test_copy_round_trip():
+    from sqlalchemy import create_engine, text
+
+    engine = create_engine(os.environ["WAREHOUSE_TEST_DB_URL"])
+    df = DataFrame(
+        {
+            "text": Series(["", None, "x"], dtype="string"),
+            "int": Series([None, 1, 2], dtype="Int64"),
+            "float": Series([1.5, None, 2.5], dtype="Float64"),
+            "when": Series([datetime(2020, 2, 29), NaT, datetime(2021, 1, 1)]),
+        }
+    )
+    with engine.begin() as conn:
+        conn.execute(text("DROP TABLE IF EXISTS copy_round_trip"))
+        df.to_sql("copy_round_trip", conn, index=False, method=copy_insert)
+    try:
+        back = read_sql_table("copy_round_trip", engine)
+        assert back["text"].tolist()[0] == ""
+        assert back["text"].isna().tolist() == [False, True, False]
+        assert back["int"].isna().tolist() == [True, False, False]
+        assert back["float"].isna().tolist() == [False, True, False]
+        assert back["when"].isna().tolist() == [False, True, False]
+    finally:
+        with engine.begin() as conn:
+            conn.execute(text("DROP TABLE copy_round_trip"))
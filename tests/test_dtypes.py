@@ -0,0 +1,29 @@
+from pandas import CategoricalDtype, DataFrame, isna
+
+from d3b_warehouse_redcap.dtypes import ColumnType, apply_column_types
+
+
+def test_empty_strings_are_kept_in_text_columns():
+    df = DataFrame(
+        {
+            "notes": ["", "some text", None],
+            "weight": ["", "1.5", "2"],
+            "visit_date": ["", "2020-01-02", "2020-03-04"],
+            "sex": ["", "Male", "Female"],
+        }
+    )
+    types = {
+        "notes": ColumnType("string", None),
+        "weight": ColumnType("Float64", None),
+        "visit_date": ColumnType("datetime64[ns]", None),
+        "sex": ColumnType(CategoricalDtype(["Female", "Male"]), None),
+    }
+    assert apply_column_types(df, types) == list(types)
+
+    assert str(df["notes"].dtype) == "string"
+    assert df["notes"][0] == ""
+    assert df["notes"][1] == "some text"
+    assert isna(df["notes"][2])
+    for c in ["weight", "visit_date", "sex"]:
+        assert isna(df[c][0])
+        assert df[c][1:].notna().all()
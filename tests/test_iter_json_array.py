@@ -0,0 +1,65 @@
+import json
+
+import pytest
+
+from d3b_warehouse_redcap.io import iter_json_array
+
+
+class FakeResponse:
+    """A streamed response whose body arrives in chunks of a fixed size"""
+
+    encoding = "utf-8"
+
+    def __init__(self, body):
+        self.body = body.encode() if isinstance(body, str) else body
+
+    def iter_content(self, chunk_size):
+        for i in range(0, len(self.body), chunk_size):
+            yield self.body[i : i + chunk_size]
+
+
+RECORDS = [
+    {"record_id": "1", "name": "Zoë", "notes": "a, b ] c"},
+    {"record_id": "22", "weight": 12345.5, "tags": ["x", "y"]},
+    "text",
+    1234567,
+    -0.25,
+    True,
+    None,
+]
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 7, 1000])
+def test_values_split_across_chunks(chunk_size):
+    resp = FakeResponse(json.dumps(RECORDS))
+    assert list(iter_json_array(resp, chunk_size)) == RECORDS
+
+
+def test_whitespace_between_elements():
+    body = ' \n[ 1 ,\t"a"\r\n,  {"b" : [ 2 , 3 ] }\n,\n12 ]\n '
+    for chunk_size in (1, 4, 1000):
+        assert list(iter_json_array(FakeResponse(body), chunk_size)) == [
+            1,
+            "a",
+            {"b": [2, 3]},
+            12,
+        ]
+
+
+@pytest.mark.parametrize("body", ["[]", " [ ] ", "[\n]"])
+def test_empty_array(body):
+    assert list(iter_json_array(FakeResponse(body), 1)) == []
+
+
+@pytest.mark.parametrize("body", ['{"a": 1}', '"a"', "1", "null"])
+def test_not_an_array(body):
+    with pytest.raises(ValueError):
+        list(iter_json_array(FakeResponse(body), 2))
+
+
+@pytest.mark.parametrize(
+    "body", ["", "[", '[{"a": 1}', '[{"a": 1},', "[12", '[{"a": ']
+)
+def test_truncated(body):
+    with pytest.raises(ValueError):
+        list(iter_json_array(FakeResponse(body), 2))
@@ -0,0 +1,74 @@
+from pandas import DataFrame
+from sqlalchemy import create_engine, event, text
+
+from d3b_warehouse_redcap.warehouse import load_tables
+
+SCHEMA = "redcap_1"
+
+
+def sqlite_engine(tmp_path):
+    """SQLite engine with SCHEMA attached as its own database"""
+    engine = create_engine(f"sqlite:///{tmp_path}/warehouse.db")
+
+    @event.listens_for(engine, "connect")
+    def attach(dbapi_conn, record):
+        dbapi_conn.execute(
+            f"ATTACH DATABASE '{tmp_path}/{SCHEMA}.db' AS \"{SCHEMA}\""
+        )
+
+    return engine
+
+
+def instrument(values):
+    return DataFrame(
+        {
+            "CID": [f"C{i}" for i in range(len(values))],
+            "redcap_event_name": ["baseline_arm_1"] * len(values),
+            "value": values,
+        }
+    )
+
+
+def rowids(engine, name):
+    """{CID: (rowid, value)}, where a rewritten row gets a new rowid"""
+    with engine.connect() as conn:
+        return {
+            cid: (rowid, value)
+            for rowid, cid, value in conn.execute(
+                text(f'SELECT rowid, "CID", value FROM "{SCHEMA}"."{name}"')
+            )
+        }
+
+
+def test_diff_load_writes_only_changed_rows(tmp_path):
+    engine = sqlite_engine(tmp_path)
+    dfs = {
+        "visits": instrument(["a", "b", "c", "d"]),
+        "labs": instrument(["w", "x", "y"]),
+    }
+    load_tables(engine, dfs, SCHEMA, load_mode="diff")
+    before = {name: rowids(engine, name) for name in dfs}
+
+    dfs["visits"].loc[1, "value"] = "B"
+    dfs["labs"] = instrument(["w", "x", "y", "z"])
+    counts = load_tables(engine, dfs, SCHEMA, load_mode="diff")
+
+    visits, labs = counts["visits"], counts["labs"]
+    assert visits["mode"] == labs["mode"] == "diff"
+    assert (visits["updated"], visits["inserted"], visits["deleted"]) == (
+        1,
+        0,
+        0,
+    )
+    assert (labs["updated"], labs["inserted"], labs["deleted"]) == (0, 1, 0)
+    after = {name: rowids(engine, name) for name in dfs}
+    # untouched rows keep their rowids, so they weren't rewritten
+    for name in dfs:
+        unchanged = {
+            cid
+            for cid, row in before[name].items()
+            if after[name].get(cid) == row
+        }
+        assert set(after[name]) - unchanged == (
+            {"C1"} if name == "visits" else {"C3"}
+        )
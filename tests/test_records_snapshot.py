@@ -0,0 +1,36 @@
+import os
+import stat
+from datetime import datetime
+
+import pytest
+
+pytest.importorskip("d3b_redcap_api")
+
+from d3b_warehouse_redcap.extract import RecordsSnapshot  # noqa: E402
+
+
+def test_snapshot_round_trip_is_private(tmp_path):
+    state_dir = str(tmp_path / "state")
+    snapshot = RecordsSnapshot(state_dir, 1)
+    # left world-readable by an earlier version
+    os.makedirs(snapshot.dir, mode=0o755)
+    with open(snapshot.legacy_tree_path, "wb"):
+        pass
+
+    tree = {
+        "1": {
+            "baseline_arm_1": {
+                "demographics": {None: {"dob": "2001-02-03"}},
+                "visits": {1: {"weight": "5"}, 2: {"weight": ""}},
+            }
+        }
+    }
+    when = datetime(2021, 1, 2, 3, 4, 5)
+    snapshot.save(tree, when, "abc")
+
+    assert snapshot.load() == (tree, {"time": when, "fingerprint": "abc"})
+    assert not os.path.exists(snapshot.legacy_tree_path)
+    for path in (state_dir, snapshot.dir):
+        assert stat.S_IMODE(os.stat(path).st_mode) == 0o700
+    for path in (snapshot.tree_path, snapshot.watermark_path):
+        assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
@@ -0,0 +1,130 @@
+import copy
+from datetime import datetime
+
+import pytest
+from dateutil import relativedelta
+from numpy import isnan
+from pandas import DataFrame, to_datetime
+from pandas.testing import assert_frame_equal
+
+pytest.importorskip("d3b_redcap_api")
+
+from warehouse_project import redcap_safe_dates  # noqa: E402
+
+
+def baseline_safe_dates(redcap_dfs, date_fields, dob_field="dob"):
+    """redcap_safe_dates as it was before it was vectorized"""
+    dob_df = None
+    for df in redcap_dfs.values():
+        if dob_field in df:
+            dob_df = df
+            break
+
+    dobs = {
+        e["subject"]: to_datetime(e[dob_field], errors="coerce")
+        for e in dob_df[["subject", dob_field]].to_dict(orient="records")
+    }
+
+    def date_to_age_days(birthdate, date):
+        days = (date - birthdate).days
+        if not isnan(days):
+            return days
+        else:
+            return None
+
+    def discard_if_too_old(birthdate, x):
+        if relativedelta.relativedelta(datetime.now(), birthdate).years < 90:
+            return x
+        else:
+            return None
+
+    for df in redcap_dfs.values():
+        for f in date_fields:
+            if f in df:
+                df[f] = to_datetime(df[f], errors="coerce")
+                df[f] = df.apply(
+                    lambda r: discard_if_too_old(dobs[r["subject"]], r[f]),
+                    axis=1,
+                ).values.flatten()
+                df[f + "_year"] = df[f].apply(lambda x: x.year)
+                df[f + "_as_age"] = df.apply(
+                    lambda r: date_to_age_days(dobs[r["subject"]], r[f]),
+                    axis=1,
+                ).values.flatten()
+
+
+def redcap_dfs():
+    now = datetime.now()
+    # turns 90 tomorrow, and turned 90 today
+    almost_90 = now.replace(year=now.year - 90) + relativedelta.relativedelta(
+        days=1
+    )
+    just_90 = now.replace(year=now.year - 90, hour=0, minute=0, second=0)
+    return {
+        "enrollment": DataFrame(
+            {
+                "subject": ["1", "2", "3", "4", "5"],
+                "dob": [
+                    "2000-02-29",
+                    "1920-06-01",
+                    almost_90.strftime("%Y-%m-%d"),
+                    just_90.strftime("%Y-%m-%d"),
+                    "1990-01-15",
+                ],
+                "consent_date": [
+                    "2010-03-01",
+                    "2010-03-01",
+                    "2010-03-01",
+                    "",
+                    "not a date",
+                ],
+            }
+        ),
+        "visits": DataFrame(
+            {
+                "subject": ["1", "1", "1", "2", "5", "5"],
+                "subject_visits_instance": [1, 2, 3, 1, 1, 2],
+                "visit_date": [
+                    "2020-02-29",
+                    "2021-02-28",
+                    None,
+                    "2020-01-01",
+                    "2019-13-45",
+                    "2022-07-04",
+                ],
+                "visit_datetime": [
+                    "2020-02-29 10:30",
+                    "",
+                    "2021-03-01 00:00",
+                    "2020-01-01 09:00",
+                    None,
+                    "2022-07-04 23:59",
+                ],
+            }
+        ),
+        "all_null": DataFrame(
+            {"subject": ["1", "2", "5"], "lab_date": [None, None, None]}
+        ),
+        "empty": DataFrame({"subject": [], "empty_date": []}, dtype=object),
+        "no_dates": DataFrame({"subject": ["1"], "notes": ["x"]}),
+    }
+
+
+DATE_FIELDS = [
+    "dob",
+    "consent_date",
+    "visit_date",
+    "visit_datetime",
+    "lab_date",
+    "empty_date",
+]
+
+
+def test_matches_baseline():
+    expected = redcap_dfs()
+    actual = copy.deepcopy(expected)
+    baseline_safe_dates(expected, DATE_FIELDS)
+    redcap_safe_dates(actual, DATE_FIELDS)
+    assert list(actual) == list(expected)
+    for name in expected:
+        assert_frame_equal(actual[name], expected[name], check_dtype=True)
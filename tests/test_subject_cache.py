@@ -0,0 +1,14 @@
+import os
+import stat
+
+from d3b_warehouse_redcap.brp import SubjectIndexCache
+
+
+def test_subject_cache_is_private(tmp_path):
+    cache = SubjectIndexCache(str(tmp_path / "state"), 95)
+    index = {(1, "MRN1"): 10, (2, "MRN2"): 20}
+    cache.save(index)
+
+    assert cache.load() == index
+    assert stat.S_IMODE(os.stat(cache.path).st_mode) == 0o600
+    assert stat.S_IMODE(os.stat(tmp_path / "state").st_mode) == 0o700
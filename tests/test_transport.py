@@ -0,0 +1,72 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from d3b_warehouse_redcap.io import Transport
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """Answers 503 to the first `failures` requests, then 200"""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _answer(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        self.rfile.read(length)
+        server = self.server
+        with server.lock:
+            server.hits += 1
+            failing = server.hits <= server.failures
+        body = b"busy" if failing else b"ok"
+        self.send_response(503 if failing else 200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST = _answer
+
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+    server.lock = threading.Lock()
+    server.hits = 0
+    server.failures = 0
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    server.url = f"http://127.0.0.1:{server.server_port}/"
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_get_is_retried_on_503(server):
+    server.failures = 2
+    transport = Transport(retries=3, backoff_factor=0)
+    resp = transport.request("get", server.url)
+    assert resp.status_code == 200
+    assert server.hits == 3
+    assert transport.stats()["retries"] == 2
+
+
+def test_post_is_not_retried(server):
+    server.failures = 2
+    transport = Transport(retries=3, backoff_factor=0)
+    resp = transport.request("post", server.url, data=b"x")
+    assert resp.status_code == 503
+    assert server.hits == 1
+    assert transport.stats()["retries"] == 0
+
+
+def test_connections_are_reused(server):
+    transport = Transport(backoff_factor=0)
+    for _ in range(5):
+        assert transport.request("get", server.url).content == b"ok"
+    stats = transport.stats()
+    assert stats["requests"] == 5
+    assert stats["connections_opened"] == 1
+    assert stats["connections_reused"] == 4
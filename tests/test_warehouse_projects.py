@@ -0,0 +1,19 @@
+import pytest
+
+pytest.importorskip("d3b_redcap_api")
+
+from warehouse_projects import read_config  # noqa: E402
+
+
+def test_projects_sharing_a_token_get_their_own_names(tmp_path):
+    config = tmp_path / "projects.txt"
+    config.write_text(
+        "# two projects behind one token\n"
+        "REDCAP_TOKEN BRP_TOKEN 1 CID DB\n"
+        "\n"
+        "python warehouse_project.py REDCAP_TOKEN BRP_TOKEN 2 CID DB\n"
+    )
+    assert read_config(str(config)) == {
+        "line2_REDCAP_TOKEN": ["REDCAP_TOKEN", "BRP_TOKEN", "1", "CID", "DB"],
+        "line4_REDCAP_TOKEN": ["REDCAP_TOKEN", "BRP_TOKEN", "2", "CID", "DB"],
+    }
@@ -1,20 +1,66 @@
 #!/usr/bin/env python3
 import argparse
+import gc
 import os
 import re
 import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 
 from d3b_redcap_api.df_utils import all_dfs
 from d3b_redcap_api.redcap import REDCapStudy
-from dateutil import relativedelta
-from numpy import isnan
-from pandas import DataFrame, notnull, to_datetime
+from numpy import repeat
+from pandas import (
+    DataFrame,
+    DateOffset,
+    Series,
+    notnull,
+    to_datetime,
+    to_numeric,
+)
 from pangres import upsert
-from sqlalchemy import create_engine, schema
+from sqlalchemy import create_engine, inspect, schema
 from ulid import monotonic as ulid
 
-from d3b_warehouse_redcap.brp import BRP
+from d3b_warehouse_redcap.brp import (
+    BRP,
+    SubjectIndexCache,
+    get_subject_index,
+)
+from d3b_warehouse_redcap.checkpoint import Checkpoint, CheckpointStore
+from d3b_warehouse_redcap.dtypes import (
+    apply_column_types,
+    field_column_types,
+    sql_column_types,
+)
+from d3b_warehouse_redcap.extract import (
+    RecordsSnapshot,
+    get_records_tree_batched,
+    get_records_tree_incremental,
+    pop_instrument_df,
+    tree_instruments,
+)
+from d3b_warehouse_redcap.io import (
+    Transport,
+    default_transport,
+    set_default_transport,
+)
+from d3b_warehouse_redcap.metadata import ProjectMetadata
+from d3b_warehouse_redcap.metrics import Metrics, shape
+from d3b_warehouse_redcap.warehouse import (
+    LOADERS,
+    MaskIndex,
+    create_staging_schema,
+    index_mask_table,
+    index_tables,
+    load_tables,
+    read_table_hashes,
+    record_table_hashes,
+    restore_previous_schema,
+    swap_in_staging_schema,
+    swap_load,
+    table_hash,
+)
 
 # defaults
 RC_ENROLLMENT_FORM = "enrollment"
@@ -23,43 +69,119 @@ RC_LASTNAME_FIELD = "last_name"
 RC_DOB_FIELD = "dob"
 RC_ORG_ID_FIELD = "external_id"
 RC_ORG_FIELD = "organization"
-RC_ORG_OVERRIDE = None
-CID_MAGIC_NUMBER = None
+
+
+class Enrollment:
+    """Where a project keeps its subjects' enrollment details, and how CIDs
+    are made from their BRP-eHB ids"""
+
+    def __init__(
+        self,
+        cid_magic_number,
+        form=RC_ENROLLMENT_FORM,
+        firstname_field=RC_FIRSTNAME_FIELD,
+        lastname_field=RC_LASTNAME_FIELD,
+        dob_field=RC_DOB_FIELD,
+        org_field=RC_ORG_FIELD,
+        org_id_field=RC_ORG_ID_FIELD,
+        org_override=None,
+    ):
+        self.cid_magic_number = cid_magic_number
+        self.form = form
+        self.firstname_field = firstname_field
+        self.lastname_field = lastname_field
+        self.dob_field = dob_field
+        self.org_field = org_field
+        self.org_id_field = org_id_field
+        self.org_override = org_override
+
+    @classmethod
+    def from_args(cls, args):
+        org_override = args.redcap_organization_override_value
+        return cls(
+            int(os.getenv(args.cid_magic_number_env_key)),
+            form=args.redcap_enrollment_form,
+            firstname_field=args.redcap_firstname_field,
+            lastname_field=args.redcap_lastname_field,
+            dob_field=args.redcap_dob_field,
+            org_field=args.redcap_organization_field,
+            org_id_field=args.redcap_id_within_organization_field,
+            org_override=None if org_override is None else int(org_override),
+        )
+
+    @property
+    def fields(self):
+        """All of the enrollment fields"""
+        return [
+            self.firstname_field,
+            self.lastname_field,
+            self.dob_field,
+            self.org_id_field,
+            self.org_field,
+        ]
+
+    def cid(self, ehb_id):
+        return f"C{self.cid_magic_number*int(ehb_id)}"
 
 
 def redcap_subjects_to_CIDs(
-    redcap_dfs, brp_api_url, brp_token, brp_protocol, create_if_new=True
+    redcap_dfs,
+    enrollment,
+    brp_api_url,
+    brp_token,
+    brp_protocol,
+    create_if_new=True,
+    max_workers=1,
+    max_requests_per_second=None,
+    subject_cache=None,
+    refresh_subject_cache=False,
+    apply=True,
 ):
-    """Replace REDCap DataFrame subject IDs with CIDs from the BRP-eHB"""
+    """Replace REDCap DataFrame subject IDs with CIDs from the BRP-eHB,
+    using the subjects' Enrollment details
+
+    Returns the subject -> CID map. With apply=False the DataFrames are left
+    alone, so the map can be applied later with apply_CIDs."""
     required_fields = {
-        RC_ORG_FIELD,
-        RC_ORG_ID_FIELD,
-        f"{RC_ENROLLMENT_FORM}_complete",
+        enrollment.org_field,
+        enrollment.org_id_field,
+        f"{enrollment.form}_complete",
     }
 
-    if RC_ORG_OVERRIDE is not None:
-        required_fields.remove(RC_ORG_FIELD)
+    if enrollment.org_override is not None:
+        required_fields.remove(enrollment.org_field)
 
     if create_if_new:
         # Then we're going to submit subjects that don't already have CIDs to
         # the BRP-eHB, so we need all of the required fields
-        required_fields |= {RC_FIRSTNAME_FIELD, RC_LASTNAME_FIELD, RC_DOB_FIELD}
+        required_fields |= {
+            enrollment.firstname_field,
+            enrollment.lastname_field,
+            enrollment.dob_field,
+        }
 
-    rc_subjects = {}
-    found_fields = set()
-    try:
-        for df in redcap_dfs.values():
-            for field in required_fields:
-                if field in df:
-                    for r in df[["subject", field]].to_records(index=False):
-                        rc_subjects.setdefault(r[0], {})[field] = r[1]
-                    found_fields.add(field)
-                    if found_fields == required_fields:
-                        raise StopIteration
-    except StopIteration:
-        pass
-
-    assert found_fields == required_fields, (
+    # Merge the fields from every instrument scanned until all of them have
+    # been found into one row per subject, later instruments (and rows)
+    # winning where they have a value
+    rc_subjects = None
+    for df in redcap_dfs.values():
+        fields = sorted(required_fields & set(df.columns))
+        if not fields:
+            continue
+        part = (
+            df[["subject", *fields]]
+            .drop_duplicates(subset="subject", keep="last")
+            .set_index("subject")
+        )
+        if rc_subjects is None:
+            rc_subjects = part
+        else:
+            rc_subjects = part.combine_first(rc_subjects)
+        if set(rc_subjects.columns) >= required_fields:
+            break
+
+    found_fields = set() if rc_subjects is None else set(rc_subjects.columns)
+    assert found_fields >= required_fields, (
         "We can't use the BRP-eHB API without the right REDCap enrollment"
         " fields. Are these correct?\n"
         f"\t{required_fields}"
@@ -67,154 +189,526 @@ def redcap_subjects_to_CIDs(
 
     brp = BRP(brp_api_url, brp_token)
 
-    ehb_subjects = {
-        (bs["organization"], bs["organization_subject_id"]): bs["id"]
-        for bs in brp.get_subjects(brp_protocol)
-    }
+    # Subjects we would warehouse, if they have (or get) CIDs
+    if enrollment.org_override is not None:
+        rc_subjects["_org"] = enrollment.org_override
+    else:
+        rc_subjects["_org"] = to_numeric(
+            rc_subjects[enrollment.org_field], errors="coerce"
+        )
+    # We don't warehouse subjects that aren't marked complete by the CRU
+    complete = (
+        rc_subjects["_org"].notna()
+        & rc_subjects[enrollment.org_id_field].notna()
+        & (rc_subjects[f"{enrollment.form}_complete"] == "Complete")
+    )
+    if not complete.all():
+        print(
+            f"{(~complete).sum()} subjects with incomplete enrollment"
+            " will not be warehoused"
+        )
+    eligible = rc_subjects[complete].copy()
+    eligible["_org"] = eligible["_org"].astype("int64")
+    eligible["_org_id"] = eligible[enrollment.org_id_field].astype(str)
+
+    def match(ehb_subjects):
+        """eligible with each subject's BRP-eHB id (or NA) as _ehb_id"""
+        ehb = DataFrame(
+            [
+                (org, str(org_id), id)
+                for (org, org_id), id in ehb_subjects.items()
+            ],
+            columns=["_org", "_org_id", "_ehb_id"],
+        ).drop_duplicates(subset=["_org", "_org_id"], keep="last")
+        ehb["_org"] = ehb["_org"].astype("int64")
+        return (
+            eligible.reset_index()
+            .merge(ehb, on=["_org", "_org_id"], how="left")
+            .set_index("subject")
+        )
+
+    ehb_subjects, from_cache = get_subject_index(
+        brp, brp_protocol, subject_cache, refresh_subject_cache
+    )
+    matched = match(ehb_subjects)
+    if from_cache and create_if_new and matched["_ehb_id"].isna().any():
+        # The subject may have been created since the index was cached, so
+        # check the BRP-eHB before trying to create it again.
+        print("Refreshing cached BRP-eHB subject index for new subjects")
+        ehb_subjects, from_cache = get_subject_index(
+            brp, brp_protocol, subject_cache, refresh=True
+        )
+        matched = match(ehb_subjects)
 
     # Build mapping from redcap subject to CID
-    CID_map = {}
-    for subject, r in rc_subjects.items():
-        ident = (
-            int(r.get(RC_ORG_FIELD, RC_ORG_OVERRIDE)),
-            r.get(RC_ORG_ID_FIELD),
+    known = matched[matched["_ehb_id"].notna()]
+    CID_map = {
+        subject: enrollment.cid(id) for subject, id in known["_ehb_id"].items()
+    }
+    print(f"{len(known)} subjects already in BRP-eHB")
+
+    missing = matched[matched["_ehb_id"].isna()]
+    to_create = {}
+    if create_if_new:
+        new = missing[
+            [
+                "_org",
+                "_org_id",
+                enrollment.firstname_field,
+                enrollment.lastname_field,
+                enrollment.dob_field,
+            ]
+        ].astype(object)
+        new = new.where(new.notna(), None)
+        for subject, org, org_id, first, last, dob in new.itertuples():
+            to_create[subject] = {
+                "organization": int(org),
+                "organization_subject_id": org_id,
+                "first_name": first,
+                "last_name": last,
+                "dob": dob,
+            }
+    elif len(missing):
+        print(
+            f"{len(missing)} subjects not found in BRP-eHB will not be"
+            " warehoused"
+        )
+
+    if to_create:
+        print(f"Submitting {len(to_create)} subjects to BRP-eHB... ⏳")
+        results = brp.create_subjects(
+            brp_protocol,
+            list(to_create.values()),
+            max_workers=max_workers,
+            max_requests_per_second=max_requests_per_second,
         )
-        if (None not in ident) and (
-            # We don't warehouse subjects that aren't marked complete by the CRU
-            r.get(f"{RC_ENROLLMENT_FORM}_complete")
-            == "Complete"
-        ):
-            if ident in ehb_subjects:  # Subject already in BRP-eHB
-                print(f"Subject {subject} already in BRP-eHB")
-                id = ehb_subjects[ident]
-                CID_map[subject] = f"C{CID_MAGIC_NUMBER*int(id)}"
-            elif (
-                create_if_new
-            ):  # Subject not yet in BRP-eHB -> submit to BRP-eHB
-                print(f"Submitting subject {subject} to BRP-eHB... ⏳")
+        failed = []
+        new_subjects = {}
+        for subject, (created, error) in zip(to_create, results):
+            if error is not None:
+                failed.append(subject)
+                print(f"ERROR! Failed to create subject {subject}!")
                 try:
-                    created = brp.create_subject(
-                        protocol_id=brp_protocol,
-                        organization=int(r.get(RC_ORG_FIELD, RC_ORG_OVERRIDE)),
-                        organization_subject_id=r.get(RC_ORG_ID_FIELD),
-                        first_name=r.get(RC_FIRSTNAME_FIELD),
-                        last_name=r.get(RC_LASTNAME_FIELD),
-                        dob=r.get(RC_DOB_FIELD),
-                    )
-                    created = created["response"]
-                    if created[0]:
-                        id = created[1]["id"]
-                        CID_map[subject] = f"C{CID_MAGIC_NUMBER*int(id)}"
-                    else:
-                        print("Error?", vars(created))
-                except Exception as e:
-                    print(f"ERROR! Failed to create subject {subject}!")
-                    print(f"REASON: {e.response.json()[2]}")
+                    reason = error.response.json()[2]
+                except Exception:
+                    reason = error
+                print(f"REASON: {reason}")
+                continue
+            created = created["response"]
+            if created[0]:
+                id = created[1]["id"]
+                CID_map[subject] = enrollment.cid(id)
+                sent = to_create[subject]
+                new_subjects[
+                    (sent["organization"], sent["organization_subject_id"])
+                ] = id
             else:
-                print(
-                    f"Subject {subject} not found in BRP-eHB will not be warehoused."
-                )
+                failed.append(subject)
+                print("Error?", created)
+        print(
+            f"Created {len(to_create) - len(failed)} of {len(to_create)}"
+            " subjects in BRP-eHB"
+        )
+        if failed:
+            print(f"Failed subjects will not be warehoused: {sorted(failed)}")
+        if subject_cache is not None and new_subjects:
+            subject_cache.add(new_subjects)
 
-        else:
-            print(f"SUBJECT {subject} ENROLLMENT NOT COMPLETE")
+    if apply:
+        apply_CIDs(redcap_dfs, CID_map)
+    return CID_map
 
-    # Map subject to CID
-    for df in redcap_dfs.values():
-        df["CID"] = df["subject"].map(CID_map)
+
+def apply_CIDs(redcap_dfs, CID_map):
+    """Add CIDs to REDCap DataFrames and drop subjects that don't have one"""
+    cids = Series(CID_map, dtype=object)
+    for name, df in redcap_dfs.items():
+        mapped = df["subject"].map(cids)
         # Remove subjects without CIDs
-        df.dropna(subset=["CID"], inplace=True)
+        keep = mapped.notna()
+        if keep.all():
+            df["CID"] = mapped
+        else:
+            redcap_dfs[name] = df[keep.values].assign(CID=mapped[keep])
 
 
-def redcap_safe_dates(redcap_dfs, date_fields):
-    """For subjects younger than 90, extract just years from REDCap DataFrame
-    date fields and also convert to ages in days using enrollment DOB."""
+def redcap_dobs(redcap_dfs, dob_field=RC_DOB_FIELD):
+    """Returns each subject's enrollment DOB as a Series indexed by subject"""
     dob_df = None
     for df in redcap_dfs.values():
-        if RC_DOB_FIELD in df:
+        if dob_field in df:
             dob_df = df
             break
 
-    dobs = {
-        e["subject"]: to_datetime(e[RC_DOB_FIELD], errors="coerce")
-        for e in dob_df[["subject", RC_DOB_FIELD]].to_dict(orient="records")
-    }
+    # one DOB per subject (the last one listed wins)
+    dob_rows = dob_df[["subject", dob_field]].drop_duplicates(
+        subset="subject", keep="last"
+    )
+    return Series(
+        to_datetime(dob_rows[dob_field], errors="coerce").values,
+        index=dob_rows["subject"].values,
+    )
 
-    def date_to_age_days(birthdate, date):
-        days = (date - birthdate).days
-        if not isnan(days):
-            return days
-        else:
-            return None
 
-    def discard_if_too_old(birthdate, x):
-        if relativedelta.relativedelta(datetime.now(), birthdate).years < 90:
-            return x
-        else:
-            return None
+def redcap_safe_dates(redcap_dfs, date_fields, dobs=None):
+    """For subjects younger than 90, extract just years from REDCap DataFrame
+    date fields and also convert to ages in days using enrollment DOB.
+
+    dobs (from redcap_dobs) must be given if the DOB instrument isn't among
+    redcap_dfs."""
+    if dobs is None:
+        dobs = redcap_dobs(redcap_dfs)
+
+    # Subjects 90 or older (or with unknown DOBs) don't get their dates kept.
+    # DateOffset clamps Feb 29 the same way relativedelta does.
+    young = (dobs + DateOffset(years=90)) > datetime.now()
 
     # create foo_year and foo_as_age (in days) values from each date that isn't
     # more than 90 years after birthdate
     for df in redcap_dfs.values():
-        for f in date_fields:
-            if f in df:
-                df[f] = to_datetime(df[f], errors="coerce")
-                df[f] = df.apply(
-                    lambda r: discard_if_too_old(dobs[r["subject"]], r[f]),
-                    axis=1,
-                ).values.flatten()
-                df[f + "_year"] = df[f].apply(lambda x: x.year)
-                df[f + "_as_age"] = df.apply(
-                    lambda r: date_to_age_days(dobs[r["subject"]], r[f]), axis=1
-                ).values.flatten()
-
-
-def submit_to_warehouse(db_engine, schema_name, dfs, fields_to_mask):
-    """Send our DataFrames to the warehouse DB"""
-    if not db_engine.dialect.has_schema(db_engine, schema_name):
+        fields = [f for f in dict.fromkeys(date_fields) if f in df]
+        if not fields:
+            continue
+
+        if df.empty:
+            # Nothing to compute. Empty instruments have always been loaded
+            # with the date, _year and _as_age columns all as object dtype.
+            for f in fields:
+                for c in [f, f + "_year", f + "_as_age"]:
+                    df[c] = Series([], index=df.index, dtype=object)
+            continue
+
+        # merge DOBs onto the instrument once
+        subject_dobs = df["subject"].map(dobs)
+        keep = df["subject"].map(young).fillna(False).astype(bool).values
+
+        dates = df[fields].apply(to_datetime, errors="coerce")
+        dates = dates.where(repeat(keep[:, None], len(fields), axis=1))
+        years = dates.apply(lambda s: s.dt.year)
+        ages = dates.sub(subject_dobs, axis=0).apply(lambda s: s.dt.days)
+
+        for f in fields:
+            df[f] = dates[f]
+            df[f + "_year"] = years[f]
+            age = ages[f]
+            if age.isna().all():
+                age = Series([None] * len(age), index=age.index, dtype=object)
+            df[f + "_as_age"] = age
+
+
+REDACTED = "[Could contain PHI]"
+
+
+def redact(redcap_dfs, fields_to_redact, drop=False):
+    """Overwrite (or drop) fields that could contain PHI. Returns what was
+    redacted."""
+    fields_to_redact = set(fields_to_redact)
+    redaction_messages = []
+    for instrument, df in redcap_dfs.items():
+        cols = [c for c in df.columns if c in fields_to_redact]
+        if not cols:
+            continue
+        redaction_messages += [f"Redacting {instrument}.{c}" for c in cols]
+        if drop:
+            df.drop(columns=cols, inplace=True)
+        else:
+            df[cols] = DataFrame(REDACTED, index=df.index, columns=cols)
+    return redaction_messages
+
+
+def normalize_dtypes(redcap_dfs, column_types=None):
+    """Give columns their data dictionary types (from field_column_types),
+    use None for all other nulls, and let pandas pick the best dtypes for
+    the rest"""
+    for k, df in redcap_dfs.items():
+        typed = set(apply_column_types(df, column_types or {}))
+        # convert_dtypes already makes nulls pd.NA in every column it
+        # converts, so only the columns left as object need None filled in
+        for c in df.columns:
+            if c in typed:
+                continue
+            df[c] = df[c].convert_dtypes()
+            if df[c].dtype == object and df[c].isna().any():
+                df[c] = df[c].where(df[c].notna(), None)
+
+
+def submit_to_warehouse(
+    db_engine,
+    schema_name,
+    dfs,
+    fields_to_mask,
+    load_mode="replace",
+    loader="insert",
+    max_workers=4,
+    mask_index=None,
+    metrics=None,
+    column_types=None,
+    rewrite_unchanged=False,
+    extra_indexes=None,
+):
+    """Send our DataFrames to the warehouse DB
+
+    Tables and mask tables are loaded concurrently over up to max_workers
+    database connections, and a table that fails to load leaves the others
+    as they were (see load_tables). Pass the same MaskIndex to repeated
+    calls to avoid re-reading the mask tables each time. column_types (from
+    field_column_types) sets the SQL types of date and choice columns.
+
+    Tables whose content hash matches the one recorded when they were last
+    loaded are skipped (mask submission included), unless rewrite_unchanged.
+    Returns the names of the tables that were skipped.
+
+    Loaded tables are indexed on their CID, subject, event and repeat
+    instance columns, plus any extra_indexes ({table: [[column, ...], ...]}),
+    and analyzed. Mask tables are indexed on their private values."""
+    metrics = metrics or Metrics()
+    if load_mode == "swap" and db_engine.dialect.name != "postgresql":
+        print("Schema swap needs PostgreSQL, so using replace")
+        load_mode = "replace"
+
+    if (
+        load_mode != "swap"
+        and schema_name not in inspect(db_engine).get_schema_names()
+    ):
         # requires schema creation privilege
         db_engine.execute(schema.CreateSchema(schema_name))
 
-    submissions = {}
-    for field, (domain, table) in fields_to_mask.items():
-        for name, df in dfs.items():
-            if field in df:
-                for v in df[field]:
-                    submissions.setdefault(table, []).append(
-                        {"private": v, "domain": domain}
-                    )
-
-    # submit identifiers to mask
-    for table, subs in submissions.items():
-        upsert(
-            engine=db_engine,
-            df=DataFrame(subs).set_index(["private"], drop=True),
-            table_name=table,
-            if_row_exists="ignore",
-            chunksize=10000,
-        )
+    # leave out tables that haven't changed since they were last loaded
+    with metrics.stage("change_detection", dfs) as st:
+        hashes = {name: table_hash(df) for name, df in dfs.items()}
+        live_tables = set()
+        if schema_name in inspect(db_engine).get_schema_names():
+            live_tables = set(inspect(db_engine).get_table_names(schema_name))
+        unchanged = set()
+        if not rewrite_unchanged:
+            loaded = read_table_hashes(db_engine, schema_name)
+            unchanged = {
+                name
+                for name, h in hashes.items()
+                if loaded.get(name) == h and name in live_tables
+            }
+        changed = {n: df for n, df in dfs.items() if n not in unchanged}
+        if unchanged:
+            print(f"Unchanged since last load: {', '.join(sorted(unchanged))}")
+        st.record["skipped"] = sorted(unchanged)
+        st.record["written"] = sorted(changed)
+
+    # distinct non-null identifiers to mask, per mask table
+    with metrics.stage("mask_submission", changed) as st:
+        submissions = {}
+        for field, (domain, table) in fields_to_mask.items():
+            for name, df in changed.items():
+                if field in df:
+                    subs = submissions.setdefault(table, {})
+                    for v in df[field].dropna().unique():
+                        subs.setdefault(v, domain)
+
+        # submit only identifiers that aren't registered yet, one mask
+        # table per connection
+        if mask_index is None:
+            mask_index = MaskIndex(db_engine)
+
+        def submit_mask(table, subs):
+            new, known = mask_index.split(table, subs)
+            print(
+                f"Mask table {table}: {len(new)} new identifiers,"
+                f" {len(known)} already registered"
+            )
+            if new:
+                upsert(
+                    engine=db_engine,
+                    df=DataFrame(
+                        {"private": new, "domain": [subs[v] for v in new]}
+                    ).set_index(["private"], drop=True),
+                    table_name=table,
+                    if_row_exists="ignore",
+                    chunksize=10000,
+                )
+                mask_index.add(table, new)
+                index_mask_table(db_engine, table)
+            return {"new": len(new), "known": len(known)}
+
+        # SQLite allows only one writer at a time
+        mask_workers = 1 if db_engine.dialect.name == "sqlite" else max_workers
+        with ThreadPoolExecutor(max_workers=mask_workers) as pool:
+            futures = {
+                table: pool.submit(submit_mask, table, subs)
+                for table, subs in submissions.items()
+            }
+        st.record["tables"] = {t: f.result() for t, f in futures.items()}
 
     # submit data
-    for name, df in dfs.items():
-        df.to_sql(
-            name,
+    dtypes = {
+        name: sql_column_types(df, column_types or {})
+        for name, df in changed.items()
+    }
+    if load_mode == "swap":
+        # the new schema gets the hashes of every table, kept ones included
+        with metrics.stage("table_load", changed, mode="swap") as st:
+            counts = swap_load(
+                db_engine,
+                changed,
+                schema_name,
+                loader,
+                max_workers,
+                dtypes,
+                keep=sorted(unchanged),
+                on_staged=lambda staging: record_table_hashes(
+                    db_engine,
+                    staging,
+                    hashes,
+                    {name: len(df) for name, df in dfs.items()},
+                ),
+                extra_indexes=extra_indexes,
+            )
+            for name in changed:
+                print(f"Loaded {schema_name}.{name}: {counts[name]}")
+            st.record["tables"] = counts
+        return sorted(unchanged)
+
+    with metrics.stage("table_load", changed, mode=load_mode) as st:
+        counts = load_tables(
             db_engine,
-            index=False,
-            if_exists="replace",
-            schema=schema_name,
-            method="multi",
-            chunksize=10000,
+            changed,
+            schema_name,
+            load_mode,
+            loader,
+            max_workers,
+            dtypes,
+            extra_indexes,
         )
+        for name in changed:
+            print(f"Loaded {schema_name}.{name}: {counts[name]}")
+        st.record["tables"] = counts
+    # unchanged tables may still be missing newly asked for indexes
+    index_tables(
+        db_engine,
+        schema_name,
+        {name: dfs[name].columns for name in unchanged},
+        extra_indexes,
+        analyze=False,
+    )
+    record_table_hashes(
+        db_engine,
+        schema_name,
+        {name: hashes[name] for name in changed},
+        {name: len(df) for name, df in changed.items()},
+    )
+    return sorted(unchanged)
 
 
-if __name__ == "__main__":
+def do_backfill(
+    study,
+    metadata,
+    redcap_dfs,
+    fields_to_fill,
+    chunk_size=500,
+    max_workers=4,
+):
+    """Fills fields_to_fill with ULIDs if not already populated
+
+    metadata is the study's ProjectMetadata."""
+    records = []
+
+    for field in fields_to_fill:
+        form = metadata.field_forms.get(field)
+        assert form
+        assert form in redcap_dfs
+
+        # classic (non-longitudinal) projects have no events
+        event = None
+        if metadata.instrument_event_mappings:
+            event = metadata.form_events.get(form)
+            assert event
+        event_name = {} if event is None else {"redcap_event_name": event}
+
+        # add the new ULIDs where needed
+        df = redcap_dfs[form]
+        existing = set()
+        if field in df:
+            dff = df[field].where(notnull(df[field]), None)
+            existing = set(dff.dropna()) - {""}
+            missing = dff.isna() | (dff == "")
+            dff[missing] = [ulid.new().str for _ in range(missing.sum())]
+            df[field] = dff
+        else:
+            df[field] = [ulid.new().str for _ in range(len(df))]
+
+        new = df[~df[field].isin(existing)]
+        instance_col = f"subject_{form}_instance"
+        instances = (
+            new[instance_col].tolist()
+            if instance_col in new
+            else [""] * len(new)
+        )
+        records.extend(
+            {
+                "field_name": field,
+                "record": subject,
+                **event_name,
+                "redcap_repeat_instance": instance,
+                "redcap_repeat_instrument": form if instance else "",
+                "value": value,
+            }
+            for subject, instance, value in zip(
+                new["subject"], instances, new[field]
+            )
+        )
+
+    if not records:
+        print("No new backfill values to send.")
+        return
+
+    chunks = [
+        records[i : i + chunk_size] for i in range(0, len(records), chunk_size)
+    ]
+    print(
+        f"Sending {len(records)} new backfill values in"
+        f" {len(chunks)} chunks..."
+    )
+    failed = 0
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = {
+            pool.submit(study.set_records, chunk): i
+            for i, chunk in enumerate(chunks, 1)
+        }
+        for done, f in enumerate(as_completed(futures), 1):
+            i = futures[f]
+            try:
+                result = f.result()
+                print(f"[{done}/{len(chunks)}] chunk {i}: {result}")
+            except Exception as e:
+                failed += len(chunks[i - 1])
+                print(f"[{done}/{len(chunks)}] chunk {i} FAILED: {e}")
 
-    class MyParser(argparse.ArgumentParser):
-        def error(self, message):
-            sys.stderr.write(f"\nerror: {message}\n\n")
-            if not isinstance(sys.exc_info()[1], argparse.ArgumentError):
-                self.print_help()
-            sys.exit(2)
+    if failed:
+        # Don't warehouse IDs that REDCap doesn't have
+        print(f"ERROR! {failed} backfill values were not saved to REDCap")
+        sys.exit(1)
 
+
+# Engines (and their connection pools) are kept for the life of the process,
+# so running several projects in one process doesn't reconnect for each.
+_db_engines = {}
+
+
+def get_db_engine(url):
+    """Returns the shared SQLAlchemy engine for a database URL"""
+    if url not in _db_engines:
+        _db_engines[url] = create_engine(url)
+    return _db_engines[url]
+
+
+class MyParser(argparse.ArgumentParser):
+    def error(self, message):
+        sys.stderr.write(f"\nerror: {message}\n\n")
+        if not isinstance(sys.exc_info()[1], argparse.ArgumentError):
+            self.print_help()
+        sys.exit(2)
+
+
+def build_parser():
+    """Returns the command line parser for a single project run"""
     parser = MyParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 
     # required arguments
@@ -316,6 +810,13 @@ if __name__ == "__main__":
         ret = [ret[0], (ret[1], ret[2])]
         return ret
 
+    parser.add_argument(
+        "--redaction",
+        required=False,
+        choices=["replace", "drop"],
+        default="replace",
+        help=f'Replace redacted fields\' values with "{REDACTED}" or drop the columns',
+    )
     parser.add_argument(
         "--mask",
         required=False,
@@ -334,18 +835,346 @@ if __name__ == "__main__":
         type=split_on_eq,
         help="Fields to backfill in REDCap with arbitrary stable IDs before warehousing. These then get masked. (this flag is repeatable)",
     )
+    parser.add_argument(
+        "--backfill_chunk_size",
+        required=False,
+        type=int,
+        default=500,
+        help="Backfill values to send to REDCap per import request",
+    )
+    parser.add_argument(
+        "--backfill_workers",
+        required=False,
+        type=int,
+        default=4,
+        help="Backfill import requests to send to REDCap concurrently",
+    )
     parser.add_argument(
         "--only_warehouse_if_CID_already_exists",
         required=False,
         action="store_true",
         help="Only warehouse subjects that already have CIDs",
     )
+    parser.add_argument(
+        "--brp_max_workers",
+        required=False,
+        type=int,
+        default=4,
+        help="Most BRP-eHB subject creation requests to have in flight at once",
+    )
+    parser.add_argument(
+        "--brp_max_requests_per_second",
+        required=False,
+        type=float,
+        default=5,
+        help="Cap on how many BRP-eHB subject creation requests start per second (0 for no cap)",
+    )
 
-    args = parser.parse_args()
+    parser.add_argument(
+        "--brp_cache_ttl_hours",
+        required=False,
+        type=float,
+        default=24,
+        help="How long the locally cached BRP-eHB subject index stays usable (0 disables the cache)",
+    )
+    parser.add_argument(
+        "--refresh_brp_cache",
+        required=False,
+        action="store_true",
+        help="Download the BRP-eHB subject index even if the cached one is fresh",
+    )
+    parser.add_argument(
+        "--http_pool_size",
+        required=False,
+        type=int,
+        default=10,
+        help="Most keep-alive connections to hold open per HTTP host",
+    )
+    parser.add_argument(
+        "--http_retries",
+        required=False,
+        type=int,
+        default=3,
+        help="Retries for connection failures and transient 5xx responses (idempotent requests only)",
+    )
+    parser.add_argument(
+        "--http_backoff_factor",
+        required=False,
+        type=float,
+        default=0.5,
+        help="Exponential backoff factor in seconds between HTTP retries",
+    )
 
+    parser.add_argument(
+        "--incremental",
+        required=False,
+        action="store_true",
+        help="Only export REDCap records modified since the last run and merge them into that run's local snapshot",
+    )
+    parser.add_argument(
+        "--full_refresh",
+        required=False,
+        action="store_true",
+        help="With --incremental, export everything and rebuild the local snapshot",
+    )
+    parser.add_argument(
+        "--export_batch_size",
+        required=False,
+        type=int,
+        default=0,
+        help="List REDCap record IDs first and export records in batches of this many (0 exports everything in one request)",
+    )
+    parser.add_argument(
+        "--export_workers",
+        required=False,
+        type=int,
+        default=4,
+        help="Concurrent REDCap export requests with --export_batch_size",
+    )
+    parser.add_argument(
+        "--export_retries",
+        required=False,
+        type=int,
+        default=2,
+        help="Times to retry a failed REDCap export batch on its own",
+    )
+    parser.add_argument(
+        "--state_dir",
+        required=False,
+        default=".warehouse_state",
+        help="Directory for local state kept between runs (e.g. incremental REDCap snapshots)",
+    )
+
+    parser.add_argument(
+        "--checkpoint",
+        required=False,
+        action="store_true",
+        help=(
+            "Save the extract, CID-mapped and de-identified data under"
+            " <state_dir>/checkpoints (Parquet when pyarrow is installed)"
+            " so a failed run can be resumed"
+        ),
+    )
+    parser.add_argument(
+        "--resume",
+        required=False,
+        action="store_true",
+        help="Pick up the project's last unfinished checkpointed run after its last completed stage (implies --checkpoint)",
+    )
+    parser.add_argument(
+        "--replay_checkpoint",
+        required=False,
+        metavar="DIR",
+        help="Run from a saved checkpoint directory instead of exporting from REDCap",
+    )
+    parser.add_argument(
+        "--checkpoint_keep",
+        required=False,
+        type=int,
+        default=3,
+        help="How many checkpointed runs to keep per project",
+    )
+    parser.add_argument(
+        "--resume_max_age_hours",
+        required=False,
+        type=float,
+        default=24,
+        help=(
+            "Only --resume a run started within this many hours (0 for no"
+            " limit). Older checkpoints can still be run with"
+            " --replay_checkpoint"
+        ),
+    )
+
+    parser.add_argument(
+        "--load_mode",
+        required=False,
+        choices=["replace", "diff", "swap"],
+        default="replace",
+        help=(
+            "How to load instrument tables. replace rewrites every table."
+            " diff keys rows on (CID, event, repeat instance) and only"
+            " applies inserts, updates and deletes. swap loads the whole"
+            " project into a staging schema and renames it into place in"
+            " one transaction, keeping the old one as <schema>__previous."
+            " Grants on the schema and its tables, and views built on its"
+            " tables, stay with the old schema, so readers lose access and"
+            " views keep showing the previous load: grant with ALTER DEFAULT"
+            " PRIVILEGES and recreate dependent views after each swap."
+        ),
+    )
+    parser.add_argument(
+        "--load_workers",
+        required=False,
+        type=int,
+        default=4,
+        help=(
+            "Database connections to load tables and mask identifiers over"
+            " concurrently. Unless streaming, a table that fails to load"
+            " leaves every table as it was. Replacing on PostgreSQL, the"
+            " tables are staged and then swapped in together, which briefly"
+            " blocks readers of the whole project at once. Diffs, and loads"
+            " into other databases, go over one connection and block"
+            " readers until every table has loaded."
+        ),
+    )
+
+    def split_index(s):
+        table, sep, columns = s.partition("=")
+        columns = [c.strip() for c in columns.split(",") if c.strip()]
+        if not (sep and table.strip() and columns):
+            raise argparse.ArgumentTypeError(
+                f"Value '{s}' must be in the form TABLE=COLUMN[,COLUMN...]"
+            )
+        return [table.strip(), columns]
+
+    parser.add_argument(
+        "--index",
+        required=False,
+        action="append",
+        metavar="TABLE=COLUMN[,COLUMN...]",
+        default=[],
+        type=split_index,
+        help=(
+            "Also index this warehouse table on these columns, besides its"
+            " CID, subject, event and repeat instance columns (this flag is"
+            " repeatable)"
+        ),
+    )
+    parser.add_argument(
+        "--restore_previous_load",
+        required=False,
+        action="store_true",
+        help="Swap the project's schema with the one kept by the last swap load, then exit",
+    )
+
+    parser.add_argument(
+        "--rewrite_unchanged",
+        required=False,
+        action="store_true",
+        help="Load every table even if its content hash matches the one from its last load",
+    )
+
+    parser.add_argument(
+        "--loader",
+        required=False,
+        choices=LOADERS,
+        default="insert",
+        help=(
+            "How rows are written. insert uses multi-row INSERTs. copy"
+            " streams rows through PostgreSQL COPY into a staging table"
+            " that then replaces the live one (falls back to insert on"
+            " other databases)."
+        ),
+    )
+
+    parser.add_argument(
+        "--stream",
+        required=False,
+        action="store_true",
+        help=(
+            "Take one instrument at a time through de-identification and"
+            " loading to bound memory use. Unless checkpointing, each"
+            " instrument's DataFrame is only built from the REDCap export"
+            " when its turn comes. Mask identifiers are submitted per"
+            " instrument."
+        ),
+    )
+
+    parser.add_argument(
+        "--metrics_file",
+        required=False,
+        help="Write per-stage timing, memory and row counts for the run here as JSON (- for one line on stdout)",
+    )
+    parser.add_argument(
+        "--profile_stage",
+        required=False,
+        action="append",
+        metavar="STAGE",
+        default=[],
+        help=(
+            "Run this stage under cProfile (this flag is repeatable). Stages:"
+            " extraction, backfill, cid_lookup, cid_mapping, safe_dates,"
+            " redaction, dtype_conversion, change_detection, mask_submission,"
+            " table_load"
+        ),
+    )
+    parser.add_argument(
+        "--profile_dir",
+        required=False,
+        default=".",
+        help="Directory for --profile_stage cProfile stats files",
+    )
+
+    return parser
+
+
+class ProjectPipeline:
+    """
+    Warehouses one REDCap project, configured by parsed command line
+    arguments (see build_parser).
+
+    What can outlive a run (the database engine, HTTP connections and the
+    known mask identifiers) is kept on the pipeline, so running it again in
+    the same process starts warm.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.enrollment = Enrollment.from_args(args)
+        self.transport = Transport(
+            pool_maxsize=args.http_pool_size,
+            retries=args.http_retries,
+            backoff_factor=args.http_backoff_factor,
+        )
+        # Create the db engine early to catch if our URL is malformed
+        self.db_engine = get_db_engine(os.getenv(args.warehouse_url_env_key))
+        self.mask_index = MaskIndex(self.db_engine)
+
+    def run(self):
+        """Warehouse the project once. Returns the run's Metrics."""
+        args = self.args
+        set_default_transport(self.transport)
+        metrics = Metrics(args.profile_stage, args.profile_dir)
+        status = "failed"
+        try:
+            with metrics.observing_requests():
+                run_project(
+                    args,
+                    self.db_engine,
+                    metrics,
+                    self.enrollment,
+                    self.mask_index,
+                )
+            status = "ok"
+        except SystemExit as e:
+            status = "exited" if e.code in (None, 0) else "failed"
+            raise
+        finally:
+            if args.metrics_file:
+                metrics.write(
+                    args.metrics_file,
+                    project=args.redcap_token_env_key,
+                    status=status,
+                    http_transport=self.transport.stats(),
+                )
+        return metrics
+
+
+def main(argv=None):
+    """Warehouse one REDCap project, configured by command line arguments"""
+    ProjectPipeline(build_parser().parse_args(argv)).run()
+
+
+def run_project(args, db_engine, metrics, enrollment, mask_index=None):
+    """The warehousing pipeline for one project, with each stage measured"""
+    mask_index = mask_index or MaskIndex(db_engine)
     fields_to_fillmask = dict(args.fillmask)
     fields_to_mask = dict(args.mask)
     fields_to_mask.update(fields_to_fillmask)
+    extra_indexes = {}
+    for table, columns in args.index:
+        extra_indexes.setdefault(table, []).append(columns)
 
     create_if_new = not args.only_warehouse_if_CID_already_exists
     redcap_api_url = args.redcap_api_url
@@ -353,165 +1182,336 @@ if __name__ == "__main__":
     brp_api_url = args.brp_api_url
     brp_token = os.getenv(args.brp_token_env_key)
     brp_protocol = args.brp_protocol
-    CID_MAGIC_NUMBER = int(os.getenv(args.cid_magic_number_env_key))
-    warehouse_url = os.getenv(args.warehouse_url_env_key)
-
-    RC_ENROLLMENT_FORM = args.redcap_enrollment_form
-    RC_FIRSTNAME_FIELD = args.redcap_firstname_field
-    RC_LASTNAME_FIELD = args.redcap_lastname_field
-    RC_DOB_FIELD = args.redcap_dob_field
-    RC_ORG_FIELD = args.redcap_organization_field
-    if args.redcap_organization_override_value is not None:
-        RC_ORG_OVERRIDE = int(args.redcap_organization_override_value)
-    RC_ORG_ID_FIELD = args.redcap_id_within_organization_field
-
-    # Create the db engine early to catch if our URL is malformed
-    db_engine = create_engine(warehouse_url)
 
     # ### read from redcap ###
 
     rs = REDCapStudy(redcap_api_url, redcap_token)
-    records_tree, errors = rs.get_records_tree()
-
-    if errors:
-        print(errors)
-        sys.exit()
-
-    data_dictionary = rs.get_data_dictionary()
-    redcap_dfs = all_dfs(records_tree)
-
-    # ### backfill auto-generated IDs ###
-
-    def do_backfill(study, data_dictionary, redcap_dfs, fields_to_fill):
-        """Fills fields_to_fill with ULIDs if not already populated"""
-        records = []
-
-        # find the form and event for each of the given field names
-        for field in fields_to_fill:
-            form = None
-            event = None
-            for d in data_dictionary:
-                if d["field_name"] == field:
-                    form = d["form_name"]
-                    break
-            for m in study.get_instrument_event_mappings():
-                if m["form"] == form:
-                    event = m["unique_event_name"]
-                    break
 
-            assert event
-            assert form
-            assert form in redcap_dfs
-
-            # add the new ULIDs where needed
-            df = redcap_dfs[form]
-            existing = {}
-            if field in df:
-                dff = df[field].where(notnull(df[field]), None)
-                existing = set(dff.dropna()) - {""}
-                df[field] = dff.apply(lambda x: ulid.new().str if not x else x)
-            else:
-                df[field] = [ulid.new().str for i in range(len(df))]
-
-            records.extend(
-                [
-                    {
-                        "field_name": field,
-                        "record": r["subject"],
-                        "redcap_event_name": event,
-                        "redcap_repeat_instance": r.get(
-                            f"subject_{form}_instance", ""
-                        ),
-                        "redcap_repeat_instrument": (
-                            form if r.get(f"subject_{form}_instance") else ""
-                        ),
-                        "value": r[field],
-                    }
-                    for r in df.to_dict(orient="records")
-                    if r[field] not in existing
-                ]
+    checkpoints = None
+    if args.checkpoint or args.resume:
+        checkpoints = CheckpointStore(
+            os.path.join(args.state_dir, "checkpoints"),
+            keep=args.checkpoint_keep,
+        )
+
+    checkpoint = None
+    if args.replay_checkpoint:
+        checkpoint = Checkpoint(args.replay_checkpoint)
+    else:
+        metadata = ProjectMetadata(rs, args.state_dir)
+        project_info = metadata.project_info
+
+        if args.restore_previous_load:
+            restore_previous_schema(
+                db_engine, f"redcap_{project_info['project_id']}"
             )
+            print("Restored the previous warehouse load")
+            sys.exit()
 
-        if records:
-            print(f"Sending {len(records)} new backfill values...")
-            print(study.set_records(records))
-        else:
-            print("No new backfill values to send.")
+        if args.resume:
+            checkpoint = checkpoints.latest_incomplete(
+                project_info["project_id"],
+                max_age=(args.resume_max_age_hours * 3600) or None,
+            )
+            if checkpoint is None:
+                print("No unfinished run to resume; starting from scratch")
 
-    do_backfill(rs, data_dictionary, redcap_dfs, fields_to_fillmask.keys())
+    # instruments left in records_tree to build as they stream
+    records_tree, pending = None, []
+    if checkpoint is not None:
+        # Everything the later stages need from REDCap was saved with the
+        # extract, so a checkpoint can be replayed without reaching REDCap.
+        print(
+            f"Resuming from {checkpoint.path}"
+            f" after stage {checkpoint.last_stage}"
+        )
+        metadata = ProjectMetadata(rs, args.state_dir, **checkpoint.metadata)
+        project_info = metadata.project_info
+        redcap_dfs = checkpoint.load(checkpoint.last_stage)
+    else:
+        # Streamed runs build each instrument's DataFrame from the records
+        # tree only when it is its turn, unless the whole extract has to be
+        # checkpointed.
+        lazy = args.stream and checkpoints is None
+        with metrics.stage("extraction") as st:
+            if args.incremental:
+                records_tree, errors = get_records_tree_incremental(
+                    rs,
+                    redcap_api_url,
+                    redcap_token,
+                    metadata.data_dictionary,
+                    RecordsSnapshot(
+                        args.state_dir, project_info["project_id"]
+                    ),
+                    full_refresh=args.full_refresh,
+                    batch_size=args.export_batch_size,
+                    max_workers=args.export_workers,
+                    retries=args.export_retries,
+                )
+            elif args.export_batch_size:
+                records_tree, errors = get_records_tree_batched(
+                    rs,
+                    redcap_api_url,
+                    redcap_token,
+                    metadata.record_id_field,
+                    batch_size=args.export_batch_size,
+                    max_workers=args.export_workers,
+                    retries=args.export_retries,
+                )
+            else:
+                records_tree, errors = rs.get_records_tree()
+
+            if errors:
+                print(errors)
+                # a non-zero exit, so the run counts as failed
+                sys.exit("REDCap export failed")
+
+            if lazy:
+                # Only build the instruments needed before streaming (for
+                # CIDs, DOBs and backfill) now, and the rest as they stream.
+                needed = {enrollment.form} | {
+                    metadata.field_forms.get(f)
+                    for f in [*enrollment.fields, *fields_to_fillmask]
+                }
+                pending = tree_instruments(records_tree)
+                redcap_dfs = {}
+                for name in [n for n in pending if n in needed]:
+                    df = pop_instrument_df(records_tree, name)
+                    if df is not None:
+                        redcap_dfs[name] = df
+                pending = [n for n in pending if n not in needed]
+                st.record["pending"] = len(pending)
+            else:
+                redcap_dfs = all_dfs(records_tree)
+                del records_tree
+            gc.collect()
+            st.output(redcap_dfs)
+
+        # ### backfill auto-generated IDs ###
+
+        with metrics.stage("backfill", redcap_dfs) as st:
+            do_backfill(
+                rs,
+                metadata,
+                redcap_dfs,
+                fields_to_fillmask.keys(),
+                chunk_size=args.backfill_chunk_size,
+                max_workers=args.backfill_workers,
+            )
+            st.output(redcap_dfs)
+
+        if checkpoints is not None:
+            with metrics.stage("checkpoint", redcap_dfs, at="extract"):
+                checkpoint = checkpoints.create(
+                    project_info["project_id"],
+                    redcap_dfs,
+                    metadata=metadata.to_dict(),
+                )
+                checkpoint.save("extract", redcap_dfs)
+    completed = checkpoint.stages if checkpoint is not None else []
 
     # ### de-identify and redact ###
 
-    identifier_fields = [
-        f["field_name"] for f in data_dictionary if f["identifier"]
-    ]
-    date_fields = [
-        d["field_name"]
-        for d in data_dictionary
-        if "date" in d["text_validation_type_or_show_slider_number"]
-    ]
-    note_fields = [
-        d["field_name"] for d in data_dictionary if d["field_type"] == "notes"
-    ]
+    date_fields = metadata.date_fields
     fields_to_redact = (
         set(
-            identifier_fields
+            metadata.identifier_fields
             + date_fields
-            + note_fields
+            + metadata.note_fields
             + args.redact
-            + [
-                RC_FIRSTNAME_FIELD,
-                RC_LASTNAME_FIELD,
-                RC_DOB_FIELD,
-                RC_ORG_ID_FIELD,
-                RC_ORG_FIELD,
-            ]
+            + enrollment.fields
         )
         - fields_to_mask.keys()
     )
+    # redacted fields no longer hold values of their field's type
+    column_types = {
+        c: t
+        for c, t in field_column_types(
+            metadata.data_dictionary, metadata.choice_map
+        ).items()
+        if c not in fields_to_redact
+    }
 
-    # The BRP-eHB wants raw org values, not readable ones, so we need to swap those.
-    raw2org = rs.get_selector_choice_map().get(RC_ORG_FIELD, {})
-    org2raw = {v: k for k, v in raw2org.items()}
-    if org2raw:
-        for df in redcap_dfs.values():
-            if RC_ORG_FIELD in df:
-                df[RC_ORG_FIELD] = df[RC_ORG_FIELD].map(org2raw)
-
-    # Get CIDs from the BRP-eHB.
-    redcap_subjects_to_CIDs(
-        redcap_dfs,
-        brp_api_url,
-        brp_token,
-        brp_protocol,
-        create_if_new=create_if_new,
+    # whether redcap_dfs already have CIDs
+    mapped = "cids" in completed and bool(
+        checkpoint.manifest["stages"]["cids"]["tables"]
     )
+    if "cids" in completed:
+        lookups = checkpoint.lookups("cids")
+        CID_map = dict(lookups["CIDs"].itertuples(index=False, name=None))
+        dobs = lookups["dobs"]["dob"]
+    else:
+        with metrics.stage("cid_lookup", redcap_dfs) as st:
+            # The BRP-eHB wants raw org values, not readable ones, so we need to swap those.
+            raw2org = metadata.choice_map.get(enrollment.org_field, {})
+            org2raw = {v: k for k, v in raw2org.items()}
+            if org2raw:
+                for df in redcap_dfs.values():
+                    if enrollment.org_field in df:
+                        df[enrollment.org_field] = df[
+                            enrollment.org_field
+                        ].map(org2raw)
 
-    # Now swap the orgs back in case we change our mind about redacting them later.
-    if raw2org:
-        for df in redcap_dfs.values():
-            if RC_ORG_FIELD in df:
-                df[RC_ORG_FIELD] = df[RC_ORG_FIELD].map(raw2org)
+            # Get CIDs from the BRP-eHB.
+            subject_cache = None
+            if args.brp_cache_ttl_hours > 0:
+                subject_cache = SubjectIndexCache(
+                    args.state_dir,
+                    brp_protocol,
+                    ttl=args.brp_cache_ttl_hours * 3600,
+                )
+            CID_map = redcap_subjects_to_CIDs(
+                redcap_dfs,
+                enrollment,
+                brp_api_url,
+                brp_token,
+                brp_protocol,
+                create_if_new=create_if_new,
+                max_workers=args.brp_max_workers,
+                max_requests_per_second=args.brp_max_requests_per_second,
+                subject_cache=subject_cache,
+                refresh_subject_cache=args.refresh_brp_cache,
+                apply=False,
+            )
 
-    # Replace dates with year+age when safe
-    redcap_safe_dates(redcap_dfs, date_fields)
+            # Now swap the orgs back in case we change our mind about redacting them later.
+            if raw2org:
+                for df in redcap_dfs.values():
+                    if enrollment.org_field in df:
+                        df[enrollment.org_field] = df[
+                            enrollment.org_field
+                        ].map(raw2org)
 
-    redaction_messages = []
-    for field in fields_to_redact:
-        for instrument in redcap_dfs:
-            if field in redcap_dfs[instrument]:
-                redaction_messages.append(f"Redacting {instrument}.{field}")
-                redcap_dfs[instrument][field] = "[Could contain PHI]"
+            dobs = redcap_dobs(redcap_dfs, enrollment.dob_field)
+            st.record["subjects_with_CIDs"] = len(CID_map)
 
-    for m in sorted(redaction_messages):
-        print(m)
+        if checkpoint is not None:
+            # Streamed runs map CIDs per instrument, so only the lookups are
+            # saved and the extract is reused on resume.
+            if not args.stream:
+                with metrics.stage("cid_mapping", redcap_dfs) as st:
+                    apply_CIDs(redcap_dfs, CID_map)
+                    st.output(redcap_dfs)
+                mapped = True
+            with metrics.stage("checkpoint", redcap_dfs, at="cids"):
+                checkpoint.save(
+                    "cids",
+                    None if args.stream else redcap_dfs,
+                    lookups={
+                        "CIDs": DataFrame(
+                            list(CID_map.items()), columns=["subject", "CID"]
+                        ),
+                        "dobs": dobs.to_frame("dob"),
+                    },
+                )
 
-    for k, df in redcap_dfs.items():
-        redcap_dfs[k] = df.where(notnull(df), None).convert_dtypes()
+    def deidentify(dfs, **attrs):
+        """Map CIDs, make dates safe, redact, and settle dtypes"""
+        if "deidentified" in completed:
+            return
+        if not mapped:
+            with metrics.stage("cid_mapping", dfs, **attrs) as st:
+                apply_CIDs(dfs, CID_map)
+                st.output(dfs)
+        # Replace dates with year+age when safe
+        with metrics.stage("safe_dates", dfs, **attrs) as st:
+            redcap_safe_dates(dfs, date_fields, dobs)
+            st.output(dfs)
+        with metrics.stage("redaction", dfs, **attrs) as st:
+            for m in sorted(
+                redact(dfs, fields_to_redact, drop=args.redaction == "drop")
+            ):
+                print(m)
+            st.output(dfs)
+        with metrics.stage("dtype_conversion", dfs, **attrs) as st:
+            normalize_dtypes(dfs, column_types)
+            st.output(dfs)
 
     # ### submit data to warehouse ###
 
-    project_info = rs.get_project_info()
     db_schema_name = f"redcap_{project_info['project_id']}"
-    redcap_dfs["redcap_project_info"] = DataFrame.from_dict([project_info])
-    submit_to_warehouse(db_engine, db_schema_name, redcap_dfs, fields_to_mask)
+    project_info_dfs = {
+        "redcap_project_info": DataFrame.from_dict([project_info])
+    }
+
+    if not args.stream:
+        deidentify(redcap_dfs)
+        if checkpoint is not None and "deidentified" not in completed:
+            with metrics.stage("checkpoint", redcap_dfs, at="deidentified"):
+                checkpoint.save("deidentified", redcap_dfs)
+        redcap_dfs.update(project_info_dfs)
+        submit_to_warehouse(
+            db_engine,
+            db_schema_name,
+            redcap_dfs,
+            fields_to_mask,
+            load_mode=args.load_mode,
+            loader=args.loader,
+            max_workers=args.load_workers,
+            mask_index=mask_index,
+            metrics=metrics,
+            column_types=column_types,
+            rewrite_unchanged=args.rewrite_unchanged,
+            extra_indexes=extra_indexes,
+        )
+    else:
+        # Take one instrument at a time all the way to the warehouse, so only
+        # it and the subject lookups are held in memory.
+        load_schema_name, load_mode = db_schema_name, args.load_mode
+        if load_mode == "swap" and db_engine.dialect.name == "postgresql":
+            load_schema_name = create_staging_schema(db_engine, db_schema_name)
+            load_mode = "replace"
+
+        # an instrument's peak_rss_mb (its own, on Linux) shows the bound
+        for name in list(redcap_dfs) + pending:
+            with metrics.stage("instrument", table=name) as st:
+                if name in redcap_dfs:
+                    df = redcap_dfs.pop(name)
+                else:
+                    df = pop_instrument_df(records_tree, name)
+                if df is None:
+                    continue
+                dfs = {name: df}
+                del df
+                st.record["in"] = shape(dfs)
+                deidentify(dfs, table=name)
+                submit_to_warehouse(
+                    db_engine,
+                    load_schema_name,
+                    dfs,
+                    fields_to_mask,
+                    load_mode=load_mode,
+                    loader=args.loader,
+                    max_workers=args.load_workers,
+                    mask_index=mask_index,
+                    metrics=metrics,
+                    column_types=column_types,
+                    rewrite_unchanged=args.rewrite_unchanged,
+                    extra_indexes=extra_indexes,
+                )
+                del dfs
+                gc.collect()
+        records_tree = None
+
+        submit_to_warehouse(
+            db_engine,
+            load_schema_name,
+            project_info_dfs,
+            {},
+            load_mode=load_mode,
+            loader=args.loader,
+            metrics=metrics,
+            rewrite_unchanged=args.rewrite_unchanged,
+            extra_indexes=extra_indexes,
+        )
+        if load_schema_name != db_schema_name:
+            swap_in_staging_schema(db_engine, db_schema_name)
+
+    if checkpoint is not None:
+        checkpoint.mark_complete()
+
+    print(f"HTTP transport: {default_transport().stats()}")
+
+
+if __name__ == "__main__":
+    main()
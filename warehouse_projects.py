@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+import argparse
+import gc
+import json
+import os
+import shlex
+import signal
+import sys
+import threading
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stderr, redirect_stdout
+
+import warehouse_project
+from d3b_warehouse_redcap.brp import BRP, SubjectIndexCache, get_subject_index
+
+
+def read_config(path):
+    """
+    Returns {project name: argument list} for warehouse_project.py from a
+    config file with one project invocation per line. Blank lines and lines
+    starting with # are skipped, and a leading "python warehouse_project.py"
+    is optional.
+    """
+    invocations = {}
+    with open(path) as f:
+        for line_number, line in enumerate(f, 1):
+            argv = shlex.split(line, comments=True)
+            if argv[:1] == ["python"] or argv[:1] == ["python3"]:
+                argv = argv[1:]
+            if argv and argv[0].endswith("warehouse_project.py"):
+                argv = argv[1:]
+            if argv:
+                invocations[project_name(line_number, argv)] = argv
+    return invocations
+
+
+def project_name(line_number, argv):
+    """
+    Short, unique label for an invocation: its config line number and its
+    REDCap token env key, which several lines may share
+    """
+    return f"line{line_number}_{argv[0]}"
+
+
+def prefetch_brp_subjects(invocations):
+    """
+    Download each BRP protocol's subject index once into the local cache,
+    so that projects sharing a protocol don't each download it.
+    """
+    parser = warehouse_project.build_parser()
+    protocols = {}
+    for argv in invocations.values():
+        args = parser.parse_args(argv)
+        if args.brp_cache_ttl_hours > 0:
+            protocols.setdefault(
+                (args.brp_protocol, args.state_dir),
+                (args.brp_api_url, args.brp_token_env_key, args),
+            )
+
+    for (protocol, state_dir), (url, token_key, args) in protocols.items():
+        print(f"Fetching BRP-eHB subjects for protocol {protocol}...")
+        cache = SubjectIndexCache(
+            state_dir, protocol, ttl=args.brp_cache_ttl_hours * 3600
+        )
+        try:
+            get_subject_index(
+                BRP(url, os.getenv(token_key)),
+                protocol,
+                cache,
+                refresh=args.refresh_brp_cache,
+            )
+        except Exception as e:
+            # each project will just fetch it for itself
+            print(f"Couldn't fetch protocol {protocol} subjects: {e}")
+
+
+def run_project(name, argv, log_dir=None, pipeline=None):
+    """
+    Run one project in this process and report how it went. With a
+    ProjectPipeline it is run again (and its log appended to) instead of
+    starting from scratch.
+    """
+    start = time.monotonic()
+    result = {"project": name, "args": argv, "status": "ok", "error": None}
+    run = pipeline.run if pipeline else lambda: warehouse_project.main(argv)
+
+    log = None
+    if log_dir:
+        log = open(
+            os.path.join(log_dir, f"{name}.log"), "a" if pipeline else "w"
+        )
+    try:
+        if log:
+            with redirect_stdout(log), redirect_stderr(log):
+                if pipeline:
+                    print(f"=== Run started {time.ctime()} ===")
+                run()
+        else:
+            run()
+    except SystemExit as e:
+        if e.code not in (None, 0):
+            result["status"] = "failed"
+            result["error"] = f"exited with {e.code}"
+    except Exception as e:
+        result["status"] = "failed"
+        result["error"] = f"{type(e).__name__}: {e}"
+        if log:
+            traceback.print_exc(file=log)
+        else:
+            traceback.print_exc()
+    finally:
+        if log:
+            log.close()
+
+    result["seconds"] = round(time.monotonic() - start, 1)
+    return result
+
+
+def report(results, seconds, summary_file=None):
+    """Print (and optionally save) a summary of project results"""
+    print("\nProject summary:")
+    for r in results:
+        line = f"  {r['project']}: {r['status']} in {r['seconds']} s"
+        if r["error"]:
+            line += f" ({r['error']})"
+        print(line)
+    failed = [r for r in results if r["status"] != "ok"]
+    print(
+        f"{len(results) - len(failed)} of {len(results)} projects succeeded"
+        f" in {seconds} s"
+    )
+
+    if summary_file:
+        with open(summary_file, "w") as f:
+            json.dump({"seconds": seconds, "projects": results}, f, indent=2)
+    return failed
+
+
+def run_daemon(invocations, interval, log_dir=None, summary_file=None):
+    """
+    Run every project, one after another in this process, every interval
+    seconds until stopped. Each project's ProjectPipeline is built once, so
+    its database engine and HTTP connections, the metadata and BRP-eHB
+    subject caches, and the imports all stay warm between rounds. Sending
+    the process SIGUSR1 starts the next round right away.
+    """
+    parser = warehouse_project.build_parser()
+    pipelines = [
+        (
+            name,
+            argv,
+            warehouse_project.ProjectPipeline(parser.parse_args(argv)),
+        )
+        for name, argv in invocations.items()
+    ]
+
+    wake = threading.Event()
+    if hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, lambda signum, frame: wake.set())
+
+    while True:
+        start = time.monotonic()
+        print(f"Starting {len(pipelines)} projects at {time.ctime()}")
+        prefetch_brp_subjects(invocations)
+        results = [
+            run_project(name, argv, log_dir, pipeline)
+            for name, argv, pipeline in pipelines
+        ]
+        report(results, round(time.monotonic() - start, 1), summary_file)
+        gc.collect()
+
+        wait = max(0, interval - (time.monotonic() - start))
+        print(f"Next round in {wait / 60:.1f} minutes")
+        wake.wait(wait)
+        wake.clear()
+
+
+def main():
+    parser = warehouse_project.MyParser(
+        description="Warehouse many REDCap projects concurrently",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        "config",
+        help=(
+            "File with one warehouse_project.py invocation (its command line"
+            " arguments) per line"
+        ),
+    )
+    parser.add_argument(
+        "--workers",
+        required=False,
+        type=int,
+        default=4,
+        help="Projects to run at once (one process each)",
+    )
+    parser.add_argument(
+        "--log_dir",
+        required=False,
+        help=(
+            "Write each project's output to <log_dir>/<project>.log instead"
+            " of the console, where <project> is line<N>_<REDCap token env"
+            " key> for the project on line N of the config"
+        ),
+    )
+    parser.add_argument(
+        "--summary_file",
+        required=False,
+        help="Also write the run summary here as JSON",
+    )
+    parser.add_argument(
+        "--daemon",
+        required=False,
+        action="store_true",
+        help=(
+            "Keep running the projects on a schedule, one at a time in this"
+            " process with connections and caches kept warm between rounds"
+        ),
+    )
+    parser.add_argument(
+        "--interval_minutes",
+        required=False,
+        type=float,
+        default=24 * 60,
+        help="With --daemon, how often a round of projects starts",
+    )
+    args = parser.parse_args()
+
+    invocations = read_config(args.config)
+    if args.log_dir:
+        os.makedirs(args.log_dir, exist_ok=True)
+
+    if args.daemon:
+        run_daemon(
+            invocations,
+            args.interval_minutes * 60,
+            args.log_dir,
+            args.summary_file,
+        )
+
+    prefetch_brp_subjects(invocations)
+
+    start = time.monotonic()
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        futures = [
+            pool.submit(run_project, name, argv, args.log_dir)
+            for name, argv in invocations.items()
+        ]
+        results = [f.result() for f in futures]
+    total = round(time.monotonic() - start, 1)
+
+    failed = report(results, total, args.summary_file)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()